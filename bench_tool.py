@@ -0,0 +1,232 @@
+import os
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+import sys
+import json
+import time
+import random
+import atexit
+import shutil
+import tempfile
+import tracemalloc
+import subprocess
+import pygame
+import game
+try:
+	import resource
+except ImportError:
+	# Windows has no resource module, the peak working set comes from psapi instead
+	resource = None
+	import ctypes
+	from ctypes import wintypes
+
+FRAME = 1000/60
+
+# Virtual clock and mouse so every run sees the same time and input
+class Replay:
+	def __init__(self):
+		self.ticks = 0.0
+		self.pos = (0, 0)
+		self.pressed = (False, False, False)
+		pygame.time.get_ticks = lambda: int(self.ticks)
+		pygame.mouse.get_pos = lambda: self.pos
+		pygame.mouse.get_pressed = lambda num_buttons=3: self.pressed
+
+	def advance(self):
+		self.ticks += FRAME
+
+	def move(self, pos):
+		self.pos = tuple(int(x) for x in pos)
+		pygame.event.post(pygame.event.Event(pygame.MOUSEMOTION, pos=self.pos, rel=(0,0), buttons=self.pressed))
+
+	def press(self, pos):
+		self.move(pos)
+		self.pressed = (True, False, False)
+		pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONDOWN, pos=self.pos, button=1))
+
+	def release(self, pos):
+		self.move(pos)
+		self.pressed = (False, False, False)
+		pygame.event.post(pygame.event.Event(pygame.MOUSEBUTTONUP, pos=self.pos, button=1))
+
+	def click(self, pos):
+		self.press(pos)
+		self.release(pos)
+
+def menuScript(replay):
+	# Hover the buttons, open settings, drag the slider and close it again
+	rect = game.data.rect
+	yield 30, lambda: replay.move(rect["buttonplay"]["center"])
+	yield 30, lambda: replay.move(rect["buttonsetting"]["center"])
+	yield 10, lambda: replay.click(rect["buttonsetting"]["center"])
+	# Actions run after the click was handled, so the screen is looked up lazily
+	handle = []
+	def press():
+		screen = game.Surfaces["SettingScreen"]
+		handle[:] = [x+y for x, y in zip(screen.musicSlider.rhandle[0].center, screen.rect.topleft)]
+		replay.press(handle)
+	yield 10, press
+	for dx in range(-150, 150, 10):
+		yield 2, lambda dx=dx: replay.move((handle[0]+dx, handle[1]))
+	yield 10, lambda: replay.release((handle[0]+150, handle[1]))
+	yield 30, lambda: replay.click(game.Surfaces["SettingScreen"].cancelRegion.rect.center)
+	yield 30, lambda: replay.move((0, 0))
+
+def snowScript(replay, count):
+	snowfall = game.Surfaces["StartScreen"].snowfall
+	width, height = snowfall.surface.get_size()
+	def fill():
+		particles = snowfall.particles
+		while particles.count < count:
+			sprite = snowfall.sprite(random.randrange(len(snowfall.snow)), random.randint(2, 19))
+			particles.spawn(
+				(random.randint(0, width-1), random.randint(0, height-1)),
+				random.choice([1,1,1,2,2,3,3,6]), random.choice([-1,0,1,1]), sprite
+			)
+	while True:
+		yield 1, fill
+
+def peakRss():
+	# Peak resident memory in KB
+	if resource is not None:
+		rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		return rss//1024 if sys.platform == "darwin" else rss
+	class Counters(ctypes.Structure):
+		_fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+			(name, ctypes.c_size_t) for name in [
+				"PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+				"QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage"
+			]
+		]
+	counters = Counters()
+	counters.cb = ctypes.sizeof(counters)
+	ctypes.windll.kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+	ctypes.windll.psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(Counters), wintypes.DWORD]
+	ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+	return counters.PeakWorkingSetSize//1024
+
+def percentile(values, p):
+	values = sorted(values)
+	return values[min(len(values)-1, int(len(values)*p/100))]
+
+def run(name, frames, size, seed):
+	random.seed(seed)
+	replay = Replay()
+	# Scripted input changes userdata, so the game saves to a copy and never to the player's file
+	folder = tempfile.mkdtemp()
+	atexit.register(shutil.rmtree, folder, True)
+	userdata = os.path.join(folder, "userdata.json")
+	if os.path.exists("userdata.json"): shutil.copyfile("userdata.json", userdata)
+	begin = time.perf_counter()
+	g = game.Game({"userdata": userdata})
+	startup = (time.perf_counter() - begin)*1000
+	if list(size) != list(pygame.display.get_surface().get_size()):
+		pygame.display.set_mode(size, pygame.RESIZABLE)
+		g.resize(size, save=False)
+	if name == "menu":
+		script = menuScript(replay)
+	elif name.startswith("snow"):
+		script = snowScript(replay, int(name[4:]))
+	else:
+		script = iter(())
+	wait, action = next(script, (None, None))
+	def step():
+		nonlocal wait, action
+		if wait is not None:
+			wait -= 1
+			if wait <= 0:
+				action()
+				wait, action = next(script, (None, None))
+		replay.advance()
+	# Timing pass, exactly `frames` frames of the scripted timeline
+	times = []
+	for i in range(frames):
+		step()
+		start = time.perf_counter_ns()
+		g.frame()
+		times.append((time.perf_counter_ns() - start)/1e6)
+	# Allocation pass afterwards, tracemalloc is started once for the whole pass
+	allocs = []
+	blocks = []
+	tracemalloc.start()
+	for i in range(max(frames//4, 1)):
+		step()
+		tracemalloc.reset_peak()
+		before, count = tracemalloc.get_traced_memory()[0], sys.getallocatedblocks()
+		g.frame()
+		allocs.append(tracemalloc.get_traced_memory()[1] - before)
+		blocks.append(sys.getallocatedblocks() - count)
+	tracemalloc.stop()
+	return {
+		"scenario": name,
+		"frames": frames,
+		"startup_ms": startup,
+		"startup": g.startup,
+		"frame_ms": {
+			"mean": sum(times)/len(times),
+			"p50": percentile(times, 50),
+			"p90": percentile(times, 90),
+			"p99": percentile(times, 99),
+			"max": max(times)
+		},
+		"alloc_bytes_per_frame": sum(allocs)/max(len(allocs), 1),
+		"blocks_per_frame": sum(blocks)/max(len(blocks), 1),
+		"peak_rss_kb": peakRss(),
+		"particles": game.Surfaces["StartScreen"].snowfall.particles.count,
+		"scale_cache": game.scaleCache.stats()
+	}
+
+def compare(results, baseline, tolerance):
+	regressions = []
+	old = {r["scenario"]: r for r in baseline["results"]}
+	for r in results:
+		if r["scenario"] not in old: continue
+		for key, value, prev in [
+			("frame_ms.p90", r["frame_ms"]["p90"], old[r["scenario"]]["frame_ms"]["p90"]),
+			("startup_ms", r["startup_ms"], old[r["scenario"]]["startup_ms"]),
+			("peak_rss_kb", r["peak_rss_kb"], old[r["scenario"]]["peak_rss_kb"])
+		]:
+			if prev and value > prev*(1+tolerance):
+				regressions.append(f"{r['scenario']} {key}: {prev:.2f} -> {value:.2f}")
+	return regressions
+
+def main(args):
+	options = {
+		"--scenarios": "startup,menu,snow100,snow1000,snow10000",
+		"--frames": "600",
+		"--size": "1280x720",
+		"--seed": "1",
+		"--out": "bench_results.json",
+		"--baseline": "",
+		"--tolerance": "0.2",
+		"--scenario": ""
+	}
+	for i in range(0, len(args)-1, 2):
+		options[args[i]] = args[i+1]
+	size = [int(x) for x in options["--size"].split("x")]
+	# Each scenario runs in its own process so peak RSS is per scenario
+	if options["--scenario"]:
+		result = run(options["--scenario"], int(options["--frames"]), size, int(options["--seed"]))
+		print(json.dumps(result))
+		return 0
+	results = []
+	for name in options["--scenarios"].split(","):
+		cmd = [sys.executable, __file__, "--scenario", name, "--frames", options["--frames"],
+			"--size", options["--size"], "--seed", options["--seed"]]
+		output = subprocess.run(cmd, capture_output=True, text=True, check=True).stdout
+		result = json.loads(output.strip().splitlines()[-1])
+		results.append(result)
+		f = result["frame_ms"]
+		print(f"{name:>10}: startup {result['startup_ms']:.1f} ms, frame p50 {f['p50']:.2f} p90 {f['p90']:.2f} "
+			f"p99 {f['p99']:.2f} ms, {result['alloc_bytes_per_frame']:.0f} B/frame, rss {result['peak_rss_kb']} KB")
+	with open(options["--out"], "w") as file:
+		file.write(json.dumps({"size": size, "seed": int(options["--seed"]), "results": results}, indent=4))
+	if options["--baseline"]:
+		with open(options["--baseline"], "r") as file:
+			regressions = compare(results, json.loads(file.read()), float(options["--tolerance"]))
+		for r in regressions: print("regression:", r)
+		return 1 if regressions else 0
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
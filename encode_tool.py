@@ -1,5 +1,12 @@
+import os
+import sys
 import json
 import base64
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+# Audio up to this many seconds also gets a pre-decoded PCM variant
+SHORT = 10
 
 def encode(src, config):
 	data = {}
@@ -17,13 +24,91 @@ def encode(src, config):
 	return data
 
 def update(path, *data):
-	try: 
+	try:
 		with open(path, "r") as file: media = json.loads(file.read())
 	except:
 		media = {}
 	for d in data: media.update(d)
 	with open(path, "w") as file: file.write(json.dumps(media, indent=4))
 
+def sources(src, config, prefix=""):
+	files = {}
+	for k, v in config.items():
+		if isinstance(v, str):
+			files[prefix+k] = f"{src}/{v}"
+		elif isinstance(v, list):
+			files.update({f"{prefix}{k}/{i}": f"{src}/{p}" for i, p in enumerate(v)})
+		else:
+			files.update(sources(src, v, f"{prefix}{k}/"))
+	return files
+
+def digest(payload):
+	return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def bake(name, path):
+	# Runs in a worker, returns the source entry and its runtime-ready variants
+	os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+	import pygame
+	from game import MediaArchive, AssetManager
+	with open(path, "rb") as f: payload = f.read()
+	ext = os.path.splitext(path)[1][1:]
+	entries = {name: (payload, ext, digest(payload))}
+	if ext == "png":
+		surface = pygame.image.load(path)
+		entries[name] += (AssetManager.scan(surface),)
+		raw = MediaArchive.rgba.pack(b"RGBA", *surface.get_size()) + pygame.image.tobytes(surface, "RGBA")
+		entries[name+"@rgba"] = (raw, "rgba", digest(raw))
+	elif ext in ("mp3", "ogg", "wav"):
+		if not pygame.mixer.get_init(): pygame.mixer.init()
+		sound = pygame.mixer.Sound(path)
+		if sound.get_length() <= SHORT:
+			raw = MediaArchive.pcm.pack(b"PCM ", *pygame.mixer.get_init()) + sound.get_raw()
+			entries[name+"@pcm"] = (raw, "pcm", digest(raw))
+	return entries
+
+def build(path, files, workers=None):
+	from game import MediaArchive
+	try:
+		with open(path+".manifest", "r") as file: manifest = json.loads(file.read())
+	except (OSError, ValueError):
+		manifest = {}
+	try:
+		archive = MediaArchive(path)
+	except (OSError, ValueError):
+		archive = None
+	keep, changed = {}, {}
+	for name, src in files.items():
+		stat = os.stat(src)
+		entry = manifest.get(name)
+		current = archive is not None and entry is not None and all(n in archive for n in entry["entries"])
+		if current and entry["file"] == src and entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+			keep[name] = entry
+			continue
+		# Touched but unchanged files only need their manifest entry refreshed
+		with open(src, "rb") as f: hash = digest(f.read())
+		if current and entry["hash"] == hash:
+			keep[name] = dict(entry, file=src, mtime=stat.st_mtime_ns, size=stat.st_size)
+		else:
+			changed[name] = src
+	media = {}
+	for name, entry in keep.items():
+		for n in entry["entries"]:
+			media[n] = (bytes(archive[n]), archive.type(n), archive.digest(n), archive.format(n))
+	if changed:
+		with ProcessPoolExecutor(max_workers=workers) as pool:
+			for name, entries in zip(changed, pool.map(bake, changed, changed.values())):
+				media.update(entries)
+				stat = os.stat(changed[name])
+				keep[name] = {
+					"file": changed[name], "mtime": stat.st_mtime_ns, "size": stat.st_size,
+					"hash": entries[name][2], "entries": list(entries)
+				}
+	if archive is not None: archive.close()
+	if changed or set(manifest) != set(keep) or archive is None:
+		MediaArchive.write(path, media)
+	with open(path+".manifest", "w") as file: file.write(json.dumps(keep, indent=4))
+	return list(changed)
+
 graphics = {
 	"startbg": "startbg.png",
 	"signboardpole": "signboardpole.png",
@@ -35,4 +120,9 @@ audio = {
 	"m1": "m1.mp3"
 }
 
-update("media.json", encode("graphics", graphics), encode("audio", audio))
+if __name__ == "__main__":
+	if "--json" in sys.argv:
+		update("media.json", encode("graphics", graphics), encode("audio", audio))
+	else:
+		rebuilt = build("media.pak", {**sources("graphics", graphics), **sources("audio", audio)})
+		print(f"media.pak: {len(rebuilt)} rebuilt", *rebuilt)
@@ -1,17 +1,26 @@
+import sys
+import json
 import pygame
-pygame.init()
+from game import FontMetrics
 
-def check(font, factor, r):
+def check(metrics, name, r):
+	path = f"{metrics.directory}/{name}"
+	font = pygame.freetype.Font(path)
 	distance = [0]
 	for i in range(*r):
-		size = factor*i
-		f = pygame.freetype.Font(font, size)
-		surf = f.render("helloHello", "#FFFFFF")[0]
+		size = metrics.size(path, i)
+		surf = font.render(metrics.sample, "#FFFFFF", size=size)[0]
 		if surf.get_height() != i:
 			distance.append(surf.get_height()-i)
-		print(f"pixel: {i}, size: {round(size)}, height: {surf.get_height()}")
+		print(f"pixel: {i}, size: {size}, height: {surf.get_height()}")
 
-	print(f"error: {len(distance)-1}, distance max: {max(distance)}")
+	print(f"error: {len(distance)-1}, distance max: {max(distance, key=abs)}")
 
-
-check("font/Marker Felt.ttf", 1.14155, (1,500))
+# Builds (or refreshes) the cached pixel height -> point size tables and checks one font
+if __name__ == "__main__":
+	pygame.init()
+	with open("settings.json", "r") as file: settings = json.loads(file.read())
+	cache = settings["assets"]["diskcache"]
+	metrics = FontMetrics("font", f"{cache}/fontmetrics.json" if cache else None, **settings["fonts"])
+	metrics.build()
+	check(metrics, sys.argv[1] if len(sys.argv) > 1 else "Marker Felt.ttf", (1, metrics.maxheight+1))
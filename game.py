@@ -8,27 +8,55 @@ import pygame
 import json
 import sys
 import base64
-from io import BytesIO
+import io
+import os
+import mmap
+import struct
 import random
+import time
+import heapq
+import atexit
+import threading
+import weakref
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict, deque
+import numpy as np
 
 class Data:
-	def __init__(self):
+	def __init__(self, paths=None):
 		self.settings = {}
 		self.userdata = {}
 		self.media = {}
 		self.language = {}
 		self.rect = {}
+		self.saveDelay = 0.5
+		self.saveChanged = 0
+		self.saveDirty = False
+		self.saveVersion = 0
+		self.savedVersion = 0
+		self.failedVersion = 0
+		self.saveLock = threading.Lock()
+		self.writeLock = threading.Lock()
+		self.saveCond = threading.Condition(self.saveLock)
+		self.writeCond = threading.Condition(self.writeLock)
 		self.paths = {
 			"settings": "settings.json",
 			"userdata": "userdata.json",
 			"media": "media.json",
+			"archive": "media.pak",
 			"language_vi": "./language/language_vi",
 			"language_en": "./language/language_en",
-			"rect": "rect.json"
+			"rect": "rect.json",
+			"font": "./font"
 		}
+		self.paths.update(paths or {})
 		self.loadSettings()
 		self.loadUserdata()
 		self.fixUserdata()
+		threading.Thread(target=self.saveLoop, daemon=True).start()
+		atexit.register(self.flush)
 		self.updateUserdata()
 		self.loadMedia()
 		self.loadLanguage()
@@ -46,8 +74,60 @@ class Data:
 			self.userdata = {}
 
 	def updateUserdata(self):
-		with open(self.paths["userdata"], "w") as file:
-			file.write(json.dumps(self.userdata, indent=4))
+		with self.saveCond:
+			self.saveDirty = True
+			self.saveChanged = time.monotonic()
+			self.saveCond.notify()
+
+	def flush(self):
+		with self.saveLock:
+			snapshot = self.snapshotUserdata() if self.saveDirty else None
+			version = self.saveVersion
+		if snapshot: self.writeUserdata(*snapshot)
+		# saveLoop may still be writing a snapshot it took before this call
+		with self.writeCond:
+			while self.savedVersion < version and self.failedVersion < version:
+				if not self.writeCond.wait(5): break
+
+	def saveLoop(self):
+		while True:
+			with self.saveCond:
+				while not self.saveDirty:
+					self.saveCond.wait()
+				# Wait for a quiet period so slider drags are written once
+				quiet = self.saveChanged + self.saveDelay - time.monotonic()
+				while self.saveDirty and quiet > 0:
+					self.saveCond.wait(quiet)
+					quiet = self.saveChanged + self.saveDelay - time.monotonic()
+				if not self.saveDirty: continue
+				snapshot = self.snapshotUserdata()
+			self.writeUserdata(*snapshot)
+
+	def snapshotUserdata(self):
+		self.saveDirty = False
+		self.saveVersion += 1
+		return self.saveVersion, json.dumps(self.userdata, indent=4)
+
+	def writeUserdata(self, version, text):
+		with self.writeLock:
+			if version <= self.savedVersion: return
+			tmp = self.paths["userdata"] + ".tmp"
+			try:
+				with open(tmp, "w") as file:
+					file.write(text)
+					file.flush()
+					os.fsync(file.fileno())
+				os.replace(tmp, self.paths["userdata"])
+			except OSError:
+				# Read-only file, full disk or a locked file on Windows, try again after the next quiet period
+				self.failedVersion = version
+				self.writeCond.notify_all()
+				failed = True
+			else:
+				self.savedVersion = version
+				self.writeCond.notify_all()
+				failed = False
+		if failed: self.updateUserdata()
 
 	def fixUserdata(self):
 		# Check resolution screen
@@ -59,6 +139,7 @@ class Data:
 				self.userdata["screensize"] = [factor*resolution[1]*ratio, factor*resolution[1]]
 			else:
 				self.userdata["screensize"] = [factor*resolution[0], factor*resolution[0]/ratio]
+		self.userdata["screensize"] = [max(x, y) for x, y in zip(self.userdata["screensize"], self.settings["ui"]["minsize"])]
 				
 		# Fix other object
 		stack = [(self.settings["userdata"], self.userdata)]
@@ -76,6 +157,11 @@ class Data:
 					stack.append((form[key], dicts[key]))
 
 	def loadMedia(self):
+		self.archive = None
+		if os.path.exists(self.paths["archive"]):
+			self.archive = MediaArchive(self.paths["archive"])
+			self.media = self.archive.tree()
+			return
 		with open(self.paths["media"], "r") as file:
 			self.media = json.loads(file.read())
 		stack = [self.media]
@@ -99,31 +185,173 @@ class Data:
 
 	def loadRect(self):
 		with open(self.paths["rect"], "r") as file:
-			self.rect = json.loads(file.read())
-		element = {
-			'topleft', 'bottomleft', 'topright', 'bottomright', 
-			'midtop', 'midleft', 'midbottom', 'midright',
-			'center'
-		}
-		size = self.userdata["screensize"]
+			rect = json.loads(file.read())
 		ratio = self.settings["ui"]["screen_ratio"][0]/self.settings["ui"]["screen_ratio"][1]
-		stdsize = [size[1]*ratio, size[1]]
-		stack = [(self.rect, size)]
+		self.layout = Layout(rect, ratio)
+		self.rect = self.layout.rect
+		self.layout.resolve(self.userdata["screensize"])
+
+class Layout:
+	element = {
+		'topleft', 'bottomleft', 'topright', 'bottomright', 
+		'midtop', 'midleft', 'midbottom', 'midright',
+		'center'
+	}
+	def __init__(self, spec, ratio):
+		self.spec = spec
+		self.ratio = ratio
+		self.rect = {}
+		self.inputs = {}
+
+	def resolve(self, size):
+		changed = set()
+		# Sizes follow the largest ratio sized area that fits the window
+		if size[0] >= size[1]*self.ratio:
+			stdsize = [size[1]*self.ratio, size[1]]
+		else:
+			stdsize = [size[0], size[0]/self.ratio]
+		stack = [(self.spec, self.rect, "", list(size))]
 		while stack:
-			item, size = stack.pop()
-			for key in item:
-				if isinstance(item[key], dict):
-					stack.append((item[key], item.get("size", size)))
-				elif key in element:
-					item[key] = [x*y for x, y in zip(item[key], size)]
-				elif key == "size":
-					item[key] = [x*y for x, y in zip(item[key], stdsize)]
+			spec, item, path, size = stack.pop()
+			# A node only depends on its parent size (positions) and the fitted screen size (size)
+			inputs = (
+				tuple(size) if any(key in self.element for key in spec) else None,
+				tuple(stdsize) if "size" in spec else None
+			)
+			if self.inputs.get(path) != inputs:
+				self.inputs[path] = inputs
+				for key, value in spec.items():
+					if key in self.element:
+						item[key] = [x*y for x, y in zip(value, size)]
+					elif key == "size":
+						item[key] = [x*y for x, y in zip(value, stdsize)]
+					elif not isinstance(value, dict):
+						item[key] = value
+				if path: changed.add(path)
+			for key, value in spec.items():
+				if isinstance(value, dict):
+					child = f"{path}/{key}" if path else key
+					stack.append((value, item.setdefault(key, {}), child, item.get("size", size)))
+		return changed
+
+	def node(self, path):
+		item = self.rect
+		for key in path.split("/"): item = item[key]
+		return item
+
+	def place(self, rect, path):
+		for k, v in self.node(path).items():
+			if k in self.element: setattr(rect, k, v)
+		return rect
+
+class MediaArchive:
+	magic = b"NGPK"
+	version = 1
+	header = struct.Struct("<4sHI")
+	# Baked variants are stored as "<name>@rgba" and "<name>@pcm"
+	rgba = struct.Struct("<4sII")
+	pcm = struct.Struct("<4sIhH")
+
+	def __init__(self, path):
+		with open(path, "rb") as file:
+			self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, size = self.header.unpack_from(self.map)
+		if magic != self.magic or version != self.version:
+			raise ValueError(f"{path} is not a media archive")
+		start = self.header.size
+		self.index = json.loads(bytes(self.map[start:start+size]))
+		self.base = start + size
+		self.view = memoryview(self.map)
+
+	def __getitem__(self, name):
+		offset, length = self.index[name][:2]
+		offset += self.base
+		return self.view[offset:offset+length]
+
+	def __contains__(self, name):
+		return name in self.index
+
+	def type(self, name):
+		return self.index[name][2]
+
+	def digest(self, name):
+		# Archives written before hashes were added get them computed once
+		entry = self.index[name]
+		if len(entry) < 4: entry.append(hashlib.blake2b(self[name], digest_size=16).hexdigest())
+		return entry[3]
+
+	def format(self, name):
+		entry = self.index[name]
+		return entry[4] if len(entry) > 4 else None
+
+	def close(self):
+		self.view.release()
+		self.map.close()
+
+	def tree(self):
+		media = {}
+		for name in self.index:
+			if "@" in name: continue
+			*path, key = name.split("/")
+			item = media
+			for k in path: item = item.setdefault(k, {})
+			item[key] = self[name]
+		# Rebuild lists from numbered keys
+		stack = [media]
+		while stack:
+			item = stack.pop()
+			for key, value in item.items():
+				if isinstance(value, dict):
+					if value and all(k.isdigit() for k in value):
+						item[key] = [value[k] for k in sorted(value, key=int)]
+					else:
+						stack.append(value)
+		return media
+
+	@classmethod
+	def write(cls, path, entries):
+		index = {}
+		offset = 0
+		for name, (payload, type, *meta) in entries.items():
+			digest = meta[0] if meta and meta[0] else hashlib.blake2b(payload, digest_size=16).hexdigest()
+			# Images carry their surface format (opaque/alpha) after the hash
+			index[name] = [offset, len(payload), type, digest] + [m for m in meta[1:] if m]
+			offset += len(payload)
+		encoded = json.dumps(index).encode()
+		tmp = path + ".tmp"
+		with open(tmp, "wb") as file:
+			file.write(cls.header.pack(cls.magic, cls.version, len(encoded)))
+			file.write(encoded)
+			for payload, *_ in entries.values(): file.write(payload)
+		os.replace(tmp, path)
+
+class MediaReader(io.RawIOBase):
+	def __init__(self, buffer):
+		self.buffer = memoryview(buffer)
+		self.pos = 0
+	def readable(self):
+		return True
+	def seekable(self):
+		return True
+	def readinto(self, b):
+		n = min(len(b), len(self.buffer) - self.pos)
+		b[:n] = self.buffer[self.pos:self.pos+n]
+		self.pos += n
+		return n
+	def seek(self, offset, whence=io.SEEK_SET):
+		if whence == io.SEEK_CUR: offset += self.pos
+		elif whence == io.SEEK_END: offset += len(self.buffer)
+		self.pos = max(0, offset)
+		return self.pos
+	def tell(self):
+		return self.pos
 
 class SurfaceManager:
 	def __init__(self, event=True, update=True, status=True):
 		self.__event = event
 		self.__update = update
 		self.__status = status
+		profiler.attach(self, type(self).__name__, ("update", "draw"))
 	@property
 	def _event(self):
 		return self.__event
@@ -139,33 +367,1233 @@ class SurfaceManager:
 		self.__event = False
 	def start_update(self):
 		self.__update = True
+		frameClock.scheduler.resumeOwner(self)
 	def pause_update(self):
 		self.__update = False
+		frameClock.scheduler.pauseOwner(self)
 	def start(self):
 		self.__status = True
+		assets.retain(self)
+		compositor.invalidate()
 	def pause(self):
 		self.__status = False
+		assets.release(self)
+		compositor.invalidate()
+
+class FrameClock:
+	def __init__(self):
+		self.now = pygame.time.get_ticks()
+		self.dt = 0
+		self.alpha = 1
+		self.scheduler = Scheduler(self.now)
+
+	def tick(self):
+		cur = pygame.time.get_ticks()
+		self.dt, self.now = cur - self.now, cur
+		self.scheduler.advance(cur)
+
+	def advance(self, dt):
+		# Fixed step, time only moves with the simulation
+		self.dt = dt
+		self.now += dt
+		self.scheduler.advance(self.now)
+
+class FramePacer:
+	def __init__(self, clock, settings):
+		self.clock = clock
+		self.settings = settings
+		self.focused = True
+		self.hidden = False
+		self.input = time.perf_counter()
+		self.last = None
+		self.target = 0
+		self.intervals = deque(maxlen=240)
+		for type in (pygame.MOUSEMOTION, pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP, pygame.MOUSEWHEEL, pygame.KEYDOWN):
+			router.subscribe(type, self.wake)
+		for type in (
+			pygame.WINDOWMINIMIZED, pygame.WINDOWRESTORED, pygame.WINDOWHIDDEN, pygame.WINDOWSHOWN,
+			pygame.WINDOWFOCUSLOST, pygame.WINDOWFOCUSGAINED
+		):
+			router.subscribe(type, self.window)
+
+	def wake(self, event=None):
+		self.input = time.perf_counter()
+
+	def window(self, event):
+		if event.type in (pygame.WINDOWMINIMIZED, pygame.WINDOWHIDDEN): self.hidden = True
+		elif event.type in (pygame.WINDOWRESTORED, pygame.WINDOWSHOWN): self.hidden = False
+		else: self.focused = event.type == pygame.WINDOWFOCUSGAINED
+		self.wake()
+
+	def state(self, animating):
+		if self.hidden: return "hidden"
+		if not self.focused: return "idle"
+		if not animating and time.perf_counter() - self.input > self.settings["idledelay"]/1000: return "idle"
+		return "active"
+
+	def wait(self, rate, animating=True):
+		state = self.state(animating)
+		if state == "hidden":
+			# Nothing is visible, sleep until an event or the timeout keeps timers going
+			event = pygame.event.wait(self.settings["hiddenwait"])
+			if event.type != pygame.NOEVENT: pygame.event.post(event)
+			self.clock.tick()
+			self.last = None
+			return state
+		if state == "idle": rate = min(rate, self.settings["idlefps"]) if rate else self.settings["idlefps"]
+		if self.settings["precise"] and rate:
+			# Sleep most of the frame, busy wait the last few ms for precision
+			elapsed = (time.perf_counter() - self.last)*1000 if self.last is not None else 0
+			remaining = 1000/rate - elapsed - self.settings["spin"]
+			if remaining > 0: time.sleep(remaining/1000)
+			self.clock.tick_busy_loop(rate)
+		else:
+			self.clock.tick(rate)
+		now = time.perf_counter()
+		if self.last is not None and state == "active" and rate == self.target:
+			self.intervals.append((now - self.last)*1000)
+		elif rate != self.target:
+			self.intervals.clear()
+		self.last = now
+		self.target = rate
+		return state
+
+	def report(self):
+		if not self.intervals or not self.target: return {"target": self.target, "mean": 0, "jitter": 0, "max": 0}
+		target = 1000/self.target
+		deviation = [abs(x - target) for x in self.intervals]
+		mean = sum(self.intervals)/len(self.intervals)
+		return {
+			"target": target, "mean": mean,
+			"jitter": (sum((x - mean)**2 for x in self.intervals)/len(self.intervals))**0.5,
+			"max": max(deviation)
+		}
+
+class Scheduler:
+	def __init__(self, now=0):
+		self.now = now
+		self.heap = []
+		self.count = 0
+		self.owners = weakref.WeakKeyDictionary()
+
+	def schedule(self, delay, callback, repeat=False, owner=None):
+		handle = {"due": self.now + delay, "delay": delay, "callback": callback, "repeat": repeat, "paused": None}
+		if owner is not None:
+			self.owners.setdefault(owner, []).append(handle)
+			if getattr(owner, "_update", True) is False: handle["paused"] = delay
+		if handle["paused"] is None: self.push(handle)
+		return handle
+
+	def push(self, handle):
+		self.count += 1
+		heapq.heappush(self.heap, (handle["due"], self.count, handle))
+
+	def cancel(self, handle):
+		handle["due"] = None
+
+	def pause(self, handle):
+		if handle["due"] is None or handle["paused"] is not None: return
+		handle["paused"] = max(0, handle["due"] - self.now)
+
+	def resume(self, handle):
+		if handle["due"] is None or handle["paused"] is None: return
+		handle["due"] = self.now + handle["paused"]
+		handle["paused"] = None
+		self.push(handle)
+
+	def pauseOwner(self, owner):
+		for handle in self.owners.get(owner, []): self.pause(handle)
+
+	def resumeOwner(self, owner):
+		for handle in self.owners.get(owner, []): self.resume(handle)
+
+	def cancelOwner(self, owner):
+		# Cancelled entries leave the heap when they come due, so nothing keeps the owner's callbacks alive
+		for handle in self.owners.pop(owner, []): self.cancel(handle)
+
+	def advance(self, now):
+		self.now = now
+		heap = self.heap
+		while heap and heap[0][0] <= now:
+			due, count, handle = heapq.heappop(heap)
+			# Skip entries left behind by cancel, pause or resume
+			if handle["due"] != due or handle["paused"] is not None: continue
+			handle["due"] = None
+			handle["callback"]()
+			if handle["repeat"] and handle["due"] is None:
+				handle["due"] = now + handle["delay"]
+				self.push(handle)
 
 class Timer:
-	def __init__(self, cooldown):
+	def __init__(self, cooldown, owner=None):
 		self.cooldown = cooldown
-		self.total = 0
-		self.prev = 0
-		self.start = True
+		self.fired = False
+		self.handle = frameClock.scheduler.schedule(cooldown, self.fire, True, owner)
+	def fire(self):
+		self.fired = True
 	def start(self):
-		self.start = True
-		self.prev = pygame.time.get_ticks() - self.total
+		frameClock.scheduler.resume(self.handle)
 	def pause(self):
-		self.start = False
+		frameClock.scheduler.pause(self.handle)
+	def cancel(self):
+		frameClock.scheduler.cancel(self.handle)
 	def update(self):
-		if not self.start: return False
-		cur = pygame.time.get_ticks()
-		if not self.prev: self.prev = cur
-		self.total += cur - self.prev
-		self.prev = cur
-		if self.total >= self.cooldown:
-			self.total = 0
+		if self.fired:
+			self.fired = False
 			return True
+		return False
+
+class DiskCache:
+	def __init__(self, path, budget=64*1024*1024):
+		self.path = path
+		self.budget = budget
+		self.entries = {}
+		self.files = {}
+		self.pending = set()
+		self.bytes = 0
+		self.hits = 0
+		# Resolutions reached by dragging the window are not worth keeping
+		self.persist = True
+		self.lock = threading.Lock()
+		self.pool = ThreadPoolExecutor(max_workers=1)
+		try:
+			os.makedirs(path, exist_ok=True)
+			files = os.listdir(path)
+		except OSError:
+			files = []
+		# File names are <key>.<w>x<h>.rgba, the size is needed by frombytes
+		for file in files:
+			key, _, rest = file.partition(".")
+			if rest and not rest.endswith((".rgba", ".tmp")) and len(key) == 32:
+				self.files[key] = os.path.join(path, file)
+			if not rest.endswith(".rgba"): continue
+			try:
+				stat = os.stat(os.path.join(path, file))
+			except OSError:
+				continue
+			size = tuple(int(x) for x in rest[:-5].split("x"))
+			self.entries[key] = [os.path.join(path, file), size, stat.st_size, stat.st_mtime]
+			self.bytes += stat.st_size
+		self.trim()
+
+	@staticmethod
+	def scaled(digest, size, smooth):
+		return f"{digest}-{int(size[0])}x{int(size[1])}-{'smooth' if smooth else 'scale'}"
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def load(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+		if entry is None: return None
+		path, size = entry[:2]
+		try:
+			with open(path, "rb") as file:
+				surface = pygame.image.frombytes(file.read(), size, "RGBA")
+			# The file time is the LRU order across launches
+			os.utime(path)
+		except (OSError, ValueError):
+			self.remove(key)
+			return None
+		entry[3] = time.time()
+		self.hits += 1
+		return surface
+
+	def save(self, key, surface):
+		if not self.persist or key in self.entries or key in self.pending: return
+		self.pending.add(key)
+		# Pixels are copied here, the file is written on the worker
+		self.pool.submit(self.write, key, surface.get_size(), pygame.image.tobytes(surface, "RGBA"))
+
+	def write(self, key, size, pixels):
+		path = os.path.join(self.path, f"{key}.{size[0]}x{size[1]}.rgba")
+		try:
+			with open(path + ".tmp", "wb") as file:
+				file.write(pixels)
+			os.replace(path + ".tmp", path)
+		except OSError:
+			self.pending.discard(key)
+			return
+		with self.lock:
+			self.entries[key] = [path, size, len(pixels), time.time()]
+			self.bytes += len(pixels)
+			self.pending.discard(key)
+		self.trim()
+
+	def remove(self, key):
+		with self.lock:
+			entry = self.entries.pop(key, None)
+			if entry is None: return
+			self.bytes -= entry[2]
+		try:
+			os.remove(entry[0])
+		except OSError:
+			pass
+
+	def trim(self):
+		# Least recently used files go first once over budget
+		if self.bytes <= self.budget: return
+		with self.lock:
+			order = sorted(self.entries, key=lambda key: self.entries[key][3])
+		for key in order:
+			if self.bytes <= self.budget: break
+			self.remove(key)
+
+	def extract(self, digest, suffix, buffer):
+		# Copies an archive entry to a plain file, so native code can read it without Python
+		if digest in self.files: return self.files[digest]
+		path = os.path.join(self.path, f"{digest}.{suffix}")
+		try:
+			with open(path + ".tmp", "wb") as file:
+				file.write(buffer)
+			os.replace(path + ".tmp", path)
+		except OSError:
+			return None
+		self.files[digest] = path
+		return path
+
+	def prune(self, digests):
+		for key in list(self.entries):
+			if key.partition("-")[0] not in digests: self.remove(key)
+		for digest in list(self.files):
+			if digest in digests: continue
+			try:
+				os.remove(self.files.pop(digest))
+			except OSError:
+				pass
+
+class ScaleCache:
+	def __init__(self, maxsize=256, maxbytes=64*1024*1024, disk=None):
+		self.maxsize = maxsize
+		self.maxbytes = maxbytes
+		self.disk = disk
+		self.cache = OrderedDict()
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key, source, size, smooth=True, owner=None):
+		# Pinned here, a disk or preload hit never runs the decode callback
+		if owner is not None: assets.pin(key, owner)
+		key = (key, (int(size[0]), int(size[1])), smooth)
+		if key in self.cache:
+			self.hits += 1
+			self.cache.move_to_end(key)
+			return self.cache[key]
+		self.misses += 1
+		if self.disk:
+			surface = self.disk.load(DiskCache.scaled(assets.digest(key[0]), *key[1:]))
+			if surface is not None:
+				surface = assets.optimize(key[0], surface)
+				self.store(key, surface)
+				return surface
+		# The source can be a callable so it is only decoded on a miss
+		if callable(source): source = source()
+		scale = pygame.transform.smoothscale if smooth else pygame.transform.scale
+		surface = scale(source, key[1])
+		if self.disk: self.disk.save(DiskCache.scaled(assets.digest(key[0]), *key[1:]), surface)
+		surface = assets.optimize(key[0], surface)
+		self.store(key, surface)
+		return surface
+
+	def put(self, key, size, surface, smooth=True):
+		if self.disk: self.disk.save(DiskCache.scaled(assets.digest(key), size, smooth), surface)
+		self.store((key, (int(size[0]), int(size[1])), smooth), assets.optimize(key, surface))
+
+	def has(self, key, size, smooth=True):
+		if (key, (int(size[0]), int(size[1])), smooth) in self.cache: return True
+		return bool(self.disk) and DiskCache.scaled(assets.digest(key), size, smooth) in self.disk
+
+	def store(self, key, surface):
+		if key in self.cache: self.bytes -= self.sizeof(self.cache.pop(key))
+		self.cache[key] = surface
+		self.bytes += self.sizeof(surface)
+		while len(self.cache) > 1 and (len(self.cache) > self.maxsize or self.bytes > self.maxbytes):
+			self.bytes -= self.sizeof(self.cache.popitem(last=False)[1])
+
+	@staticmethod
+	def sizeof(surface):
+		return surface.get_pitch()*surface.get_height()
+
+	def scaleBy(self, key, source, factor, smooth=True, owner=None):
+		size = assets.size(key) if callable(source) else source.get_size()
+		return self.get(key, source, [x*factor for x in size], smooth, owner)
+
+	def discard(self, name):
+		freed = 0
+		for key in [key for key in self.cache if key[0] == name]:
+			freed += self.sizeof(self.cache.pop(key))
+		self.bytes -= freed
+		return freed
+
+	def clear(self):
+		self.cache.clear()
+		self.bytes = 0
+
+	def stats(self):
+		return {
+			"hits": self.hits, "misses": self.misses, "size": len(self.cache),
+			"maxsize": self.maxsize, "bytes": self.bytes, "disk": self.disk.hits if self.disk else 0
+		}
+
+class Atlas:
+	def __init__(self, width=1024, maxheight=4096, padding=1):
+		self.width = width
+		self.maxheight = maxheight
+		self.padding = padding
+		self.surface = pygame.Surface((width, 64), pygame.SRCALPHA)
+		self.regions = {}
+		self.sources = {}
+		self.owners = weakref.WeakKeyDictionary()
+		self.marked = None
+		self.shelf = [0, 0, 0]
+
+	def add(self, key, surface, owner=None):
+		key = (key, surface.get_size())
+		if self.marked is not None: self.marked.add(key)
+		if owner is not None: self.owners.setdefault(owner, set()).add(key)
+		if key in self.regions: return self.regions[key]
+		rect = self.place(surface)
+		if rect is None: return None
+		self.regions[key] = rect
+		self.sources[key] = surface
+		return rect
+
+	def place(self, surface):
+		w, h = surface.get_size()
+		x, y, shelfh = self.shelf
+		if w + self.padding > self.width: return None
+		if x + w + self.padding > self.width:
+			x, y, shelfh = 0, y + shelfh, 0
+		if y + h + self.padding > self.maxheight: return None
+		if y + h + self.padding > self.surface.get_height():
+			height = self.surface.get_height()
+			while height < y + h + self.padding: height *= 2
+			grown = pygame.Surface((self.width, min(height, self.maxheight)), pygame.SRCALPHA)
+			grown.blit(self.surface, (0,0), special_flags=pygame.BLEND_RGBA_MAX)
+			self.surface = grown
+		self.surface.blit(surface, (x, y), special_flags=pygame.BLEND_RGBA_MAX)
+		self.shelf = [x + w + self.padding, y, max(shelfh, h + self.padding)]
+		return pygame.Rect(x, y, w, h)
+
+	def find(self, key, surface):
+		return self.regions.get((key, surface.get_size()))
+
+	def begin(self):
+		# Everything added again until end() is kept, the rest is dropped
+		self.marked = set()
+
+	def end(self):
+		marked, self.marked = self.marked, None
+		self.compact(marked)
+
+	def drop(self, owner):
+		# Regions only an unloaded owner used are repacked away
+		if owner not in self.owners: return
+		keys = self.owners.pop(owner)
+		used = set().union(*self.owners.values())
+		self.compact(set(self.regions) - (keys - used))
+
+	def compact(self, keep):
+		if keep.issuperset(self.regions): return
+		regions, sources, owners = self.regions, self.sources, self.owners
+		self.clear()
+		self.owners = owners
+		for keys in owners.values(): keys &= keep
+		for key, rect in regions.items():
+			if key not in keep: continue
+			placed = self.place(sources[key])
+			# Callers keep the returned rects, so they are moved in place, an empty one means no region
+			if placed is None:
+				rect.update(0, 0, 0, 0)
+				continue
+			rect.update(placed)
+			self.regions[key] = rect
+			self.sources[key] = sources[key]
+
+	def clear(self):
+		self.surface = pygame.Surface((self.width, 64), pygame.SRCALPHA)
+		self.regions = {}
+		self.sources = {}
+		self.owners = weakref.WeakKeyDictionary()
+		self.shelf = [0, 0, 0]
+
+class RenderBatch:
+	def __init__(self, target):
+		self.target = target
+		self.items = []
+		self.areas = False
+		self.calls = 0
+		self.blitted = 0
+
+	def add(self, surface, dest, area=None):
+		if area is None:
+			self.items.append((surface, dest))
+		else:
+			self.items.append((surface, dest, area))
+			self.areas = True
+
+	def sprite(self, key, surface, dest, clips=None):
+		region = None if key is None else atlas.find(key, surface)
+		source = surface if region is None else atlas.surface
+		if clips is None:
+			self.add(source, dest, region)
+			return
+		rect = surface.get_rect(topleft=(dest[0], dest[1]))
+		for clip in clips:
+			clip = rect.clip(clip)
+			if not clip: continue
+			area = clip.move(-rect.x, -rect.y)
+			if region: area.move_ip(region.topleft)
+			self.add(source, clip.topleft, area)
+
+	def extend(self, items, areas=True):
+		self.items.extend(items)
+		self.areas = self.areas or areas
+
+	def flush(self):
+		if not self.items: return
+		if not self.areas and hasattr(self.target, "fblits"):
+			self.target.fblits(self.items)
+		else:
+			self.target.blits(self.items, doreturn=False)
+		self.calls += 1
+		self.blitted += len(self.items)
+		self.items = []
+		self.areas = False
+
+class AssetManager:
+	def __init__(self, media, budget):
+		self.media = media
+		self.budget = budget
+		self.cache = OrderedDict()
+		self.sizes = {}
+		self.owners = weakref.WeakKeyDictionary()
+		self.digests = {}
+		self.formats = {}
+		self.dims = {}
+
+	def source(self, name):
+		item = self.media
+		for key in name.split("/"):
+			item = item[int(key)] if isinstance(item, list) else item[key]
+		return item
+
+	def digest(self, name):
+		if name not in self.digests:
+			if data.archive: self.digests[name] = data.archive.digest(name)
+			else: self.digests[name] = hashlib.blake2b(self.source(name), digest_size=16).hexdigest()
+		return self.digests[name]
+
+	def size(self, name):
+		# Read the PNG header instead of decoding when the image is not loaded
+		if name in self.cache: return self.cache[name].get_size()
+		if name not in self.dims:
+			buffer = self.source(name)
+			if bytes(buffer[:8]) == b"\x89PNG\r\n\x1a\n":
+				self.dims[name] = struct.unpack(">II", buffer[16:24])
+			else:
+				self.dims[name] = self.image(name).get_size()
+		return self.dims[name]
+
+	def image(self, name, owner=None):
+		if name not in self.cache:
+			surface = self.optimize(name, self.decode(name))
+			self.put(name, surface, surface.get_pitch()*surface.get_height())
+		return self.get(name, owner)
+
+	def sound(self, name, owner=None):
+		if name not in self.cache:
+			sound = self.decodeSound(name)
+			freq, size, channels = pygame.mixer.get_init()
+			self.put(name, sound, int(sound.get_length()*freq)*channels*abs(size)//8)
+		return self.get(name, owner)
+
+	def decode(self, name):
+		# Baked raw pixels skip the PNG decoder
+		if data.archive and name+"@rgba" in data.archive:
+			buffer = data.archive[name+"@rgba"]
+			magic, w, h = MediaArchive.rgba.unpack_from(buffer)
+			return pygame.image.frombuffer(buffer[MediaArchive.rgba.size:], (w, h), "RGBA")
+		return pygame.image.load(MediaReader(self.source(name)))
+
+	def format(self, name, surface):
+		if name not in self.formats:
+			format = data.archive.format(name) if data.archive and name in data.archive else None
+			self.formats[name] = format or self.scan(surface)
+		return self.formats[name]
+
+	@staticmethod
+	def scan(surface):
+		if not surface.get_flags() & pygame.SRCALPHA and surface.get_colorkey() is None: return "opaque"
+		if surface.get_bitsize() != 32 or not surface.get_flags() & pygame.SRCALPHA:
+			copy = pygame.Surface(surface.get_size(), pygame.SRCALPHA, 32)
+			copy.blit(surface, (0,0))
+			surface = copy
+		alpha = pygame.surfarray.pixels_alpha(surface)
+		return "opaque" if alpha.min() == 255 else "alpha"
+
+	def optimize(self, name, surface):
+		if self.format(name, surface) == "opaque": return surface.convert()
+		return surface.convert_alpha()
+
+	def decodeSound(self, name):
+		# Baked PCM is only usable when it matches the mixer format
+		if data.archive and name+"@pcm" in data.archive:
+			buffer = data.archive[name+"@pcm"]
+			magic, *format = MediaArchive.pcm.unpack_from(buffer)
+			if tuple(format) == pygame.mixer.get_init():
+				return pygame.mixer.Sound(buffer=buffer[MediaArchive.pcm.size:])
+		return pygame.mixer.Sound(MediaReader(self.source(name)))
+
+	def get(self, name, owner=None):
+		self.cache.move_to_end(name)
+		if owner is not None: self.pin(name, owner)
+		return self.cache[name]
+
+	def put(self, name, asset, size):
+		self.cache[name] = asset
+		self.sizes[name] = size
+		# The new entry is about to be returned, so it cannot evict itself
+		self.evict(name)
+
+	def pin(self, name, owner):
+		self.owners.setdefault(owner, [True, set()])[1].add(name)
+
+	def retain(self, owner):
+		if owner in self.owners: self.owners[owner][0] = True
+
+	def release(self, owner):
+		if owner in self.owners: self.owners[owner][0] = False
+		self.evict()
+
+	def pinned(self):
+		return set().union(*[names for active, names in self.owners.values() if active])
+
+	def evict(self, keep=None):
+		resident = self.resident()
+		if resident <= self.budget: return
+		pinned = self.pinned() | {keep}
+		derived = self.derived()
+		# Scaled copies can outlive their source, e.g. after a disk cache hit
+		for name in list(self.cache) + [name for name in derived if name not in self.cache]:
+			if resident <= self.budget: break
+			if name in pinned: continue
+			resident -= self.sizes.get(name, 0) + scaleCache.discard(name)
+			self.cache.pop(name, None)
+			self.sizes.pop(name, None)
+
+	def drop(self, owner):
+		# Forget an unloaded owner and free whatever nobody else uses
+		if owner not in self.owners: return
+		names = self.owners.pop(owner)[1]
+		used = set().union(*[names for active, names in self.owners.values()])
+		for name in names - used:
+			scaleCache.discard(name)
+			if name in self.cache:
+				self.cache.pop(name)
+				self.sizes.pop(name)
+
+	def derived(self):
+		# Bytes of the scaled copies and atlas regions made from each asset
+		sizes = {}
+		for (name, size, smooth), surface in scaleCache.cache.items():
+			sizes[name] = sizes.get(name, 0) + ScaleCache.sizeof(surface)
+		for (name, size), rect in atlas.regions.items():
+			sizes[name] = sizes.get(name, 0) + rect.w*rect.h*atlas.surface.get_bytesize()
+		return sizes
+
+	def resident(self):
+		return sum(self.sizes.values()) + sum(self.derived().values())
+
+	def report(self):
+		derived = self.derived()
+		return {
+			name: {"source": self.sizes.get(name, 0), "derived": derived.get(name, 0)}
+			for name in list(self.sizes) + [name for name in derived if name not in self.sizes]
+		}
+
+class Preloader:
+	def __init__(self, workers=None):
+		self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+		self.jobs = {}
+		self.timing = {}
+		self.begin = time.perf_counter()
+
+	def image(self, name, heights=()):
+		if name in self.jobs or name in assets.cache: return
+		if heights and all(scaleCache.has(name, self.scaled(name, height, mult)) for height, mult in heights): return
+		self.jobs[name] = ("image", self.pool.submit(self.decodeImage, name, heights))
+
+	def sound(self, name):
+		if name in self.jobs or name in assets.cache: return
+		self.jobs[name] = ("sound", self.pool.submit(self.decodeSound, name))
+
+	def add(self, jobs):
+		for kind, name, *args in jobs:
+			getattr(self, kind)(name, *args)
+
+	@staticmethod
+	def scaled(name, height, mult):
+		size = assets.size(name)
+		factor = height/size[1]*mult
+		return [int(x*factor) for x in size]
+
+	@staticmethod
+	def decodeImage(name, heights):
+		start = time.perf_counter()
+		surface = assets.decode(name)
+		scaled = []
+		# Scaling needs a 24/32 bit source, others are scaled after convert_alpha
+		if surface.get_bitsize() >= 24:
+			for height, mult in heights:
+				factor = height/surface.get_height()*mult
+				size = [int(x*factor) for x in surface.get_size()]
+				scaled.append((size, pygame.transform.smoothscale(surface, size)))
+		return surface, scaled, time.perf_counter() - start
+
+	@staticmethod
+	def decodeSound(name):
+		start = time.perf_counter()
+		sound = assets.decodeSound(name)
+		return sound, time.perf_counter() - start
+
+	def poll(self):
+		for name, (kind, future) in list(self.jobs.items()):
+			if not future.done(): continue
+			self.jobs.pop(name)
+			if kind == "image":
+				surface, scaled, elapsed = future.result()
+				surface = assets.optimize(name, surface)
+				assets.put(name, surface, surface.get_pitch()*surface.get_height())
+				for size, s in scaled: scaleCache.put(name, size, s)
+			else:
+				sound, elapsed = future.result()
+				freq, size, channels = pygame.mixer.get_init()
+				assets.put(name, sound, int(sound.get_length()*freq)*channels*abs(size)//8)
+			self.timing[name] = elapsed*1000
+		return not self.jobs
+
+	def wait(self):
+		while not self.poll():
+			pygame.event.pump()
+			time.sleep(0.001)
+
+	def report(self):
+		return {"assets": dict(self.timing), "total": (time.perf_counter() - self.begin)*1000}
+
+	def shutdown(self):
+		self.pool.shutdown(wait=False)
+
+class SceneManager:
+	def __init__(self, preloader, idle=30000):
+		self.preloader = preloader
+		self.idle = idle
+		self.factories = {}
+		self.scenes = {}
+		self.states = {}
+		self.since = {}
+		self.prefetching = set()
+
+	def register(self, name, factory):
+		self.factories[name] = factory
+		self.states[name] = "unloaded"
+
+	def load(self, name):
+		if name not in self.scenes:
+			self.scenes[name] = self.factories[name](pygame.display.get_surface())
+		return self.scenes[name]
+
+	def open(self, name, state="active"):
+		scene = self.load(name)
+		self.prefetching.discard(name)
+		self.since.pop(name, None)
+		if not scene._status: scene.start()
+		self.states[name] = state
+		return scene
+
+	def suspend(self, name):
+		self.scenes[name].pause()
+		self.states[name] = "suspended"
+		self.since[name] = frameClock.now
+
+	def unload(self, name):
+		scene = self.scenes.pop(name)
+		router.remove(scene)
+		frameClock.scheduler.cancelOwner(scene)
+		assets.drop(scene)
+		atlas.drop(scene)
+		self.states[name] = "unloaded"
+		self.since.pop(name, None)
+
+	def prefetch(self, name):
+		# Decode on the workers now, build the scene once the jobs are in
+		if name in self.scenes or name in self.prefetching: return
+		self.prefetching.add(name)
+		self.preloader.add(self.factories[name].preload(pygame.display.get_surface()))
+
+	def update(self):
+		if self.prefetching and self.preloader.poll():
+			for name in self.prefetching:
+				self.load(name)
+				self.suspend(name)
+			self.prefetching.clear()
+		for name, since in list(self.since.items()):
+			if frameClock.now - since >= self.idle: self.unload(name)
+
+	def visible(self):
+		return [scene for name, scene in self.scenes.items() if self.states[name] in ("active", "overlay")]
+
+	def values(self):
+		return list(self.scenes.values())
+
+	def __getitem__(self, name):
+		return self.scenes[name]
+
+	def __contains__(self, name):
+		return name in self.scenes
+
+	def __iter__(self):
+		return iter(self.scenes)
+
+class Compositor:
+	def __init__(self, surface, enabled=False, threshold=0.4, maxrects=256):
+		self.surface = surface
+		self.enabled = enabled
+		self.threshold = threshold
+		self.maxrects = maxrects
+		self.rects = []
+		self.force = True
+		self.full = True
+
+	def invalidate(self):
+		self.force = True
+
+	def begin(self):
+		self.full = self.force or not self.enabled
+		self.force = False
+		self.rects = []
+
+	def mark(self, rects):
+		if self.full: return None
+		area = self.surface.get_width()*self.surface.get_height()
+		if len(rects) > self.maxrects or sum(r[2]*r[3] for r in rects) > area*self.threshold:
+			self.full = True
+			return None
+		# Merge into disjoint rects so each region is restored and drawn once
+		merged = []
+		for rect in rects:
+			rect = pygame.Rect(rect).clip(self.surface.get_rect())
+			if not rect: continue
+			i = rect.collidelist(merged)
+			while i != -1:
+				rect.union_ip(merged.pop(i))
+				i = rect.collidelist(merged)
+			merged.append(rect)
+		self.rects.extend(merged)
+		return merged
+
+	def present(self):
+		if self.full:
+			pygame.display.update()
+		elif self.rects:
+			pygame.display.update(self.rects)
+
+class Layer:
+	def __init__(self, size, render, flags=pygame.SRCALPHA):
+		self.size = size
+		self.render = render
+		self.flags = flags
+		self.surface = None
+
+	def invalidate(self):
+		self.surface = None
+
+	def get(self):
+		if self.surface is None:
+			self.surface = pygame.Surface(self.size, self.flags)
+			self.render(self.surface)
+		return self.surface
+
+class LayerStack:
+	def __init__(self, size):
+		self.size = size
+		self.layers = {}
+		self.surface = None
+
+	def add(self, name, layer, dest=(0,0)):
+		self.layers[name] = (layer, dest)
+		self.surface = None
+
+	def invalidate(self, *names):
+		for name in names or self.layers: self.layers[name][0].invalidate()
+		self.surface = None
+
+	def get(self):
+		if self.surface is None:
+			self.surface = pygame.Surface(self.size, pygame.SRCALPHA)
+			for layer, dest in self.layers.values():
+				self.surface.blit(layer.get(), dest)
+		return self.surface
+
+class FontCache:
+	def __init__(self, maxsize=512):
+		self.maxsize = maxsize
+		self.fonts = {}
+		self.texts = OrderedDict()
+		self.atlases = {}
+		self.metrics = None
+		self.hits = 0
+		self.misses = 0
+
+	def font(self, path, size):
+		key = (path, size)
+		if key not in self.fonts:
+			self.fonts[key] = pygame.freetype.Font(path, size)
+		return self.fonts[key]
+
+	def render(self, path, size, text, color, style=None):
+		key = (path, size, text, tuple(color), style)
+		if key in self.texts:
+			self.hits += 1
+			self.texts.move_to_end(key)
+		else:
+			self.misses += 1
+			font = self.font(path, size)
+			self.texts[key] = font.render(text, color) if style is None else font.render(text, color, style=style)
+			while len(self.texts) > self.maxsize:
+				self.texts.popitem(last=False)
+		surface, rect = self.texts[key]
+		return surface, rect.copy()
+
+	def glyphs(self, path, size, color, chars="0123456789"):
+		key = (path, size, tuple(color), chars)
+		if key not in self.atlases:
+			self.atlases[key] = GlyphAtlas(self.font(path, size), color, chars)
+		return self.atlases[key]
+
+	def stats(self):
+		return {"fonts": len(self.fonts), "texts": len(self.texts), "hits": self.hits, "misses": self.misses}
+
+class GlyphAtlas:
+	def __init__(self, font, color, chars):
+		self.font = font
+		self.color = color
+		self.glyphs = {}
+		for c in chars:
+			surface, rect = font.render(c, color)
+			self.glyphs[c] = (surface, rect.x, rect.y, font.get_metrics(c)[0][4])
+		self.ascent = max(g[2] for g in self.glyphs.values())
+		self.height = max(g[0].get_height() - g[2] for g in self.glyphs.values()) + self.ascent
+
+	def layout(self, text, pos=(0,0)):
+		x, y = pos
+		items = []
+		for c in text:
+			if c not in self.glyphs:
+				surface, rect = self.font.render(c, self.color)
+				self.glyphs[c] = (surface, rect.x, rect.y, self.font.get_metrics(c)[0][4])
+			surface, bx, by, advance = self.glyphs[c]
+			items.append((surface, (round(x + bx), y + self.ascent - by)))
+			x += advance
+		return items, round(x - pos[0])
+
+	def draw(self, surface, pos, text):
+		items, width = self.layout(text, pos)
+		surface.blits(items, doreturn=False)
+		return pygame.Rect(pos, (width, self.height))
+
+	def render(self, text):
+		items, width = self.layout(text)
+		surface = pygame.Surface((max(width, 1), self.height), pygame.SRCALPHA)
+		surface.blits(items, doreturn=False)
+		return surface, surface.get_rect()
+
+class FontMetrics:
+	def __init__(self, directory, cache=None, sample="helloHello", maxheight=256, step=0.25):
+		self.directory = directory
+		self.cache = cache
+		self.sample = sample
+		self.maxheight = maxheight
+		self.step = step
+		self.tables = {}
+		self.hashes = {}
+		self.load()
+
+	def load(self):
+		# Tables are cached by font content, so any font path can share them
+		try:
+			with open(self.cache, "r") as file: self.cached = json.loads(file.read())
+		except (OSError, TypeError, ValueError):
+			self.cached = {}
+
+	def digest(self, path):
+		path = os.path.normpath(path)
+		if path not in self.hashes:
+			with open(path, "rb") as file: self.hashes[path] = hashlib.blake2b(file.read(), digest_size=16).hexdigest()
+		return self.hashes[path]
+
+	def stale(self, path):
+		entry = self.cached.get(self.digest(path))
+		return not entry or entry["params"] != [self.sample, self.maxheight, self.step]
+
+	def build(self, paths=None, workers=None):
+		# Only for font_tool.py, forking from the running game would copy its threads
+		if paths is None: paths = [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))]
+		paths = [path for path in paths if self.stale(path)]
+		if not paths: return
+		with ProcessPoolExecutor(max_workers=workers or min(len(paths), os.cpu_count())) as pool:
+			tables = pool.map(functools.partial(self.measure, sample=self.sample, maxheight=self.maxheight, step=self.step), paths)
+			for path, table in zip(paths, tables): self.store(path, table)
+		self.save()
+
+	def store(self, path, table):
+		self.cached[self.digest(path)] = {"params": [self.sample, self.maxheight, self.step], "table": table}
+
+	def save(self):
+		if self.cache is None: return
+		try:
+			os.makedirs(os.path.dirname(self.cache) or ".", exist_ok=True)
+			with open(self.cache + ".tmp", "w") as file: file.write(json.dumps(self.cached))
+			os.replace(self.cache + ".tmp", self.cache)
+		except OSError:
+			pass
+
+	@staticmethod
+	def measure(path, sample, maxheight, step):
+		# table[h] is the largest point size whose rendered sample is h pixels high
+		pygame.freetype.init()
+		font = pygame.freetype.Font(path)
+		table = [step]*(maxheight+1)
+		found = [False]*(maxheight+1)
+		size = step
+		while True:
+			height = font.get_rect(sample, size=size).height
+			if height > maxheight: break
+			table[height] = size
+			found[height] = True
+			size += step
+		for height in range(1, maxheight+1):
+			if not found[height]: table[height] = table[height-1]
+		return table
+
+	def table(self, path):
+		key = os.path.normpath(path)
+		if key not in self.tables:
+			if self.stale(key):
+				# Not built by font_tool.py yet, measure just this font in process
+				self.store(key, self.measure(key, self.sample, self.maxheight, self.step))
+				self.save()
+			self.tables[key] = self.cached[self.digest(key)]["table"]
+		return self.tables[key]
+
+	def size(self, path, height):
+		table = self.table(path)
+		height = max(int(round(height)), 1)
+		if height <= self.maxheight: return table[height]
+		return table[self.maxheight]*height/self.maxheight
+
+class EventRouter:
+	def __init__(self, cell=64):
+		self.cell = cell
+		self.handlers = {}
+		self.regions = {}
+		self.grid = {}
+		self.count = 0
+		self.target = None
+		self.hover = None
+
+	def subscribe(self, type, handler, owner=None):
+		self.handlers.setdefault(type, []).append((owner, handler))
+
+	def region(self, owner, name, rect, z=0):
+		key = (owner, name)
+		if key in self.regions:
+			region = self.regions[key]
+			self.unindex(region)
+		else:
+			self.count += 1
+			region = self.regions[key] = Attr(owner=owner, name=name, z=z, order=self.count)
+		region.rect = pygame.Rect(rect)
+		region.cells = [
+			(x, y)
+			for x in range(region.rect.left//self.cell, (region.rect.right-1)//self.cell + 1)
+			for y in range(region.rect.top//self.cell, (region.rect.bottom-1)//self.cell + 1)
+		]
+		for cell in region.cells: self.grid.setdefault(cell, []).append(region)
+		return region
+
+	def unindex(self, region):
+		for cell in region.cells:
+			self.grid[cell].remove(region)
+			if not self.grid[cell]: self.grid.pop(cell)
+
+	def remove(self, owner):
+		for key in [key for key in self.regions if key[0] is owner]:
+			self.unindex(self.regions.pop(key))
+		for type, handlers in self.handlers.items():
+			handlers[:] = [h for h in handlers if h[0] is not owner]
+
+	@staticmethod
+	def active(owner):
+		return owner is None or (getattr(owner, "_event", True) and getattr(owner, "_status", True))
+
+	def hit(self, pos):
+		best = None
+		for region in self.grid.get((pos[0]//self.cell, pos[1]//self.cell), ()):
+			if not region.rect.collidepoint(pos) or not self.active(region.owner): continue
+			if best is None or (region.z, region.order) > (best.z, best.order): best = region
+		return best
+
+	def begin(self):
+		self.hover = self.hit(pygame.mouse.get_pos())
+
+	def dispatch(self, event):
+		handlers = self.handlers.get(event.type)
+		if not handlers: return
+		self.target = self.hit(event.pos) if hasattr(event, "pos") else None
+		for owner, handler in handlers.copy():
+			if self.active(owner): handler(event)
+
+class Profiler:
+	def __init__(self, history=240, trace=20000):
+		self.enabled = False
+		self.size = history
+		self.history = {}
+		self.trace = deque(maxlen=trace)
+		self.stack = []
+		self.targets = weakref.WeakKeyDictionary()
+		self.prev = 0
+
+	def enable(self):
+		self.enabled = True
+		for obj, (name, methods) in self.targets.items(): self.wrap(obj, name, methods)
+
+	def disable(self):
+		self.enabled = False
+		for obj, (name, methods) in self.targets.items():
+			for m in methods: obj.__dict__.pop(m, None)
+
+	def attach(self, obj, name, methods):
+		self.targets[obj] = (name, methods)
+		if self.enabled: self.wrap(obj, name, methods)
+
+	def wrap(self, obj, name, methods):
+		for m in methods:
+			if m in obj.__dict__: continue
+			def timed(*args, call=getattr(obj, m), key=f"{name}.{m}"):
+				start = time.perf_counter_ns()
+				try:
+					return call(*args)
+				finally:
+					self.record(key, start, time.perf_counter_ns())
+			setattr(obj, m, timed)
+
+	def start(self, name):
+		self.stack.append((name, time.perf_counter_ns()))
+
+	def stop(self):
+		name, start = self.stack.pop()
+		self.record(name, start, time.perf_counter_ns())
+
+	def frame(self):
+		now = time.perf_counter_ns()
+		if self.prev: self.record("interval", self.prev, now, trace=False)
+		self.prev = now
+
+	def record(self, name, start, end, trace=True):
+		if name not in self.history: self.history[name] = deque(maxlen=self.size)
+		self.history[name].append((end - start)/1e6)
+		if trace: self.trace.append((name, start, end - start))
+
+	def fps(self):
+		interval = self.history.get("interval")
+		return 1000*len(interval)/sum(interval) if interval and sum(interval) else 0
+
+	def export(self, path):
+		events = [
+			{"name": name, "ph": "X", "ts": start/1000, "dur": dur/1000, "pid": 1, "tid": 1}
+			for name, start, dur in self.trace
+		]
+		with open(path, "w") as file:
+			file.write(json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}))
+
+class PerfOverlay:
+	def __init__(self, font, size=(260, 110)):
+		self.visible = False
+		self.glyphs = fonts.glyphs(font, 16, (255,255,255), "0123456789.")
+		self.panel = pygame.Surface(size, pygame.SRCALPHA)
+		self.rect = self.panel.get_rect(topleft=(8, 8))
+
+	def draw(self, surface, particles, jitter=0):
+		self.panel.fill((0,0,0,160))
+		frame = profiler.history.get("frame", ())
+		if frame:
+			# Frame time graph, 33 ms at the top of the panel
+			w, h = self.rect.w - 16, self.rect.h - 44
+			step = w/max(profiler.size-1, 1)
+			points = [(8 + i*step, self.rect.h - 8 - min(t, 33.3)/33.3*h) for i, t in enumerate(frame)]
+			pygame.draw.line(self.panel, (90,90,90), (8, self.rect.h-8-h/2), (8+w, self.rect.h-8-h/2))
+			if len(points) > 1: pygame.draw.lines(self.panel, (120,220,120), False, points)
+		x = self.glyphs.draw(self.panel, (8, 6), f"FPS {profiler.fps():.1f}").right + 12
+		x = self.glyphs.draw(self.panel, (x, 6), f"{frame[-1] if frame else 0:.2f} ms").right + 12
+		self.glyphs.draw(self.panel, (x, 6), f"{particles} flakes")
+		self.glyphs.draw(self.panel, (8, 24), f"jitter {jitter:.2f} ms")
+		surface.blit(self.panel, self.rect)
+		# The panel is redrawn every frame, keep the compositor on full updates
+		compositor.invalidate()
+
+class MusicTrack:
+	# pygame.mixer.music has a single stream, the playing track is shared
+	current = None
+	pending = None
+
+	def __init__(self, name, fade=0):
+		self.name = name
+		self.fade = fade
+		self.volume = 1
+		self.hint = data.archive.type(name) if data.archive else ""
+
+	def play(self, loops=0, fade_ms=None):
+		fade_ms = self.fade if fade_ms is None else fade_ms
+		if MusicTrack.pending: frameClock.scheduler.cancel(MusicTrack.pending)
+		MusicTrack.pending = None
+		if MusicTrack.current not in (None, self) and pygame.mixer.music.get_busy() and fade_ms:
+			# Fade the old track out first, then fade this one in
+			pygame.mixer.music.fadeout(fade_ms//2)
+			MusicTrack.pending = frameClock.scheduler.schedule(fade_ms//2, lambda: self.start(loops, fade_ms//2))
+			return
+		self.start(loops, fade_ms)
+
+	def start(self, loops, fade_ms):
+		MusicTrack.pending = None
+		# A Python file object would be read on SDL's audio thread, which then needs the GIL while holding
+		# the audio lock, and mixer.music calls from the main thread hold the GIL while taking that lock
+		path = scaleCache.disk.extract(assets.digest(self.name), self.hint or "music", assets.source(self.name)) if scaleCache.disk else None
+		pygame.mixer.music.load(path or MediaReader(assets.source(self.name)), self.hint)
+		pygame.mixer.music.set_volume(self.volume)
+		pygame.mixer.music.play(loops, fade_ms=fade_ms)
+		MusicTrack.current = self
+
+	def stop(self, fade_ms=0):
+		if MusicTrack.current is not self: return
+		if fade_ms: pygame.mixer.music.fadeout(fade_ms)
+		else: pygame.mixer.music.stop()
+		MusicTrack.current = None
+
+	def set_volume(self, volume):
+		self.volume = volume
+		if MusicTrack.current is self: pygame.mixer.music.set_volume(volume)
+
+	def get_volume(self):
+		return self.volume
+
+	def get_busy(self):
+		return MusicTrack.current is self and pygame.mixer.music.get_busy()
+
+	def __str__(self):
+		return f"MusicTrack({self.name})"
 
 class Audio:
 	def __init__(self, settings, media):
@@ -180,7 +1608,11 @@ class Audio:
 				self.data[k] = Audio(self.settings[k], self.media)
 				self.data[k].load()
 			elif isinstance(self.settings[k], list):
-				self.data[k] = pygame.mixer.Sound(BytesIO(self.media[self.settings[k][0]]))
+				# Entries marked "stream" play through mixer.music instead of a decoded Sound
+				if "stream" in self.settings[k][2:]:
+					self.data[k] = MusicTrack(self.settings[k][0], self.settings.get("fade", 0))
+				else:
+					self.data[k] = assets.sound(self.settings[k][0], self)
 				self.data[k].set_volume(self.volume*self.settings[k][1])
 
 	def set_volume(self, volume):
@@ -215,169 +1647,392 @@ class Attr:
 		self.__dict__.update(kwargs)
 
 class Game:
-	def __init__(self):
-		global data, Surfaces, audio
+	def __init__(self, paths=None):
+		global data, Surfaces, audio, scaleCache, atlas, assets, compositor, fonts, frameClock, router, profiler
+		begin = time.perf_counter()
 		pygame.init()
-		data = Data()
+		data = Data(paths)
+		profiler = Profiler(data.settings["debug"]["history"])
+		if data.settings["debug"]["profiler"]: profiler.enable()
+		frameClock = FrameClock()
+		router = EventRouter()
+		path = data.settings["assets"]["diskcache"]
+		scaleCache = ScaleCache(disk=DiskCache(path, data.settings["assets"]["diskbudget"]) if path else None)
+		fonts = FontCache()
+		fonts.metrics = FontMetrics(
+			data.paths["font"], os.path.join(path, "fontmetrics.json") if path else None, **data.settings["fonts"]
+		)
 		pygame.display.set_caption(data.settings["ui"]["title"])
-		pygame.display.set_mode(data.userdata["screensize"], vsync=int(data.userdata["vsync"]))
+		pygame.display.set_mode(data.userdata["screensize"], pygame.RESIZABLE, vsync=int(data.userdata["vsync"]))
+		self.fullscreen = False
+		# Show the first frame while assets are decoded in the background
+		pygame.display.get_surface().fill((0,0,0))
+		pygame.display.update()
+		atlas = Atlas()
+		compositor = Compositor(
+			pygame.display.get_surface(), data.userdata["dirtyrect"],
+			data.settings["ui"]["dirtythreshold"], data.settings["ui"]["dirtymaxrects"]
+		)
+		assets = AssetManager(data.media, data.settings["assets"]["budget"])
+		if scaleCache.disk and data.archive: scaleCache.disk.prune({data.archive.digest(name) for name in data.archive.index})
+		self.preloader = Preloader()
+		self.preloader.add(StartScreen.preload(pygame.display.get_surface()))
+		self.preloader.wait()
 		self.clock = pygame.time.Clock()
+		loop = data.settings["loop"]
+		self.fixed = loop["fixed"]
+		self.step = 1000/loop["tickrate"]
+		self.accumulator = 0
+		self.last = pygame.time.get_ticks()
+		self.skipped = 0
 
 		audio = Attr(
 			music = Audio(data.settings["audio"]["music"], data.media)
 		)
 		audio.music.set_volume(data.userdata["music"])
-		Surfaces = {}
-		Surfaces.update(StartScreen=StartScreen(pygame.display.get_surface()))
+		router.subscribe(pygame.QUIT, self.quit)
+		router.subscribe(pygame.VIDEORESIZE, self.videoresize)
+		router.subscribe(pygame.KEYDOWN, self.keydown)
+		Surfaces = SceneManager(self.preloader, data.settings["scenes"]["idle"])
+		Surfaces.register("StartScreen", StartScreen)
+		Surfaces.register("SettingScreen", SettingScreen)
+		Surfaces.open("StartScreen")
+		self.overlay = PerfOverlay(data.settings["ui"]["StartScreen"]["menu"]["font"])
+		self.pacer = FramePacer(self.clock, data.settings["loop"])
+		self.startup = self.preloader.report()
+		self.startup["total"] = (time.perf_counter() - begin)*1000
+
+	def resize(self, size, save=True, persist=False):
+		if scaleCache.disk: scaleCache.disk.persist = persist
+		changed = data.layout.resolve(size)
+		surface = pygame.display.get_surface()
+		compositor.surface = surface
+		compositor.invalidate()
+		# Regions of the old size are dropped once every scene has laid out
+		atlas.begin()
+		for s in Surfaces.values():
+			s.resize(surface, changed)
+		atlas.end()
+		# Only a size that laid out is kept for the next launch
+		if save:
+			data.userdata["screensize"] = list(size)
+			data.updateUserdata()
+
+	def toggleFullscreen(self):
+		self.fullscreen = not self.fullscreen
+		if self.fullscreen:
+			pygame.display.set_mode(pygame.display.get_desktop_sizes()[0], pygame.FULLSCREEN)
+		else:
+			pygame.display.set_mode(data.userdata["screensize"], pygame.RESIZABLE, vsync=int(data.userdata["vsync"]))
+		self.resize(pygame.display.get_surface().get_size(), save=False, persist=True)
+
+	def quit(self, event):
+		data.flush()
+		pygame.quit()
+		sys.exit()
+
+	def videoresize(self, event):
+		if not self.fullscreen: self.pending = event.size
+
+	def keydown(self, event):
+		if event.key == pygame.K_F11: self.toggleFullscreen()
+		elif event.key == pygame.K_F3:
+			self.overlay.visible = not self.overlay.visible
+			if self.overlay.visible: profiler.enable()
+			elif not data.settings["debug"]["profiler"]: profiler.disable()
+			compositor.invalidate()
+		elif event.key == pygame.K_F4 and profiler.enabled:
+			profiler.export(data.settings["debug"]["trace"])
 
 	def loop(self):
 		while True:
-			self.clock.tick(data.userdata["fps"])
-
-			for event in pygame.event.get():
-				if event.type == pygame.QUIT:
-					pygame.quit()
-					sys.exit()
-				for surface in Surfaces.copy().values():
-					if hasattr(surface, "event"):
-						surface.event(event)
-
-			for surface in Surfaces.copy().values(): 
-				surface.draw()
-			pygame.display.update()
+			animating = any(s._update for s in Surfaces.visible())
+			rate = data.userdata["fps"]
+			# The fixed step decouples updates from rendering, the cap only bounds the user's limit
+			if self.fixed:
+				cap = data.settings["loop"]["rendercap"]
+				rate = min(rate, cap) if rate else cap
+			self.pacer.wait(rate, animating)
+			self.frame()
+
+	def update(self):
+		for surface in Surfaces.visible():
+			if surface._update: surface.update()
+
+	def simulate(self):
+		loop = data.settings["loop"]
+		now = pygame.time.get_ticks()
+		self.accumulator += now - self.last
+		self.last = now
+		steps = 0
+		while self.accumulator >= self.step and steps < loop["maxsteps"]:
+			frameClock.advance(self.step)
+			self.update()
+			self.accumulator -= self.step
+			steps += 1
+		# Too far behind, drop the backlog instead of spiralling
+		if steps == loop["maxsteps"]: self.accumulator %= self.step
+		frameClock.alpha = self.accumulator/self.step
+		# Under load skip the render, never the update
+		if pygame.time.get_ticks() - now > self.step and self.skipped < loop["maxskip"]:
+			self.skipped += 1
+			return False
+		self.skipped = 0
+		return True
+
+	def frame(self):
+		profiling = profiler.enabled
+		if profiling:
+			profiler.frame()
+			profiler.start("frame")
+			profiler.start("events")
+		if not self.fixed: frameClock.tick()
+
+		self.pending = None
+		for event in pygame.event.get():
+			router.dispatch(event)
+		# Only the last size of a drag is laid out
+		if self.pending:
+			size = [max(x, y) for x, y in zip(self.pending, data.settings["ui"]["minsize"])]
+			if size != list(self.pending):
+				pygame.display.set_mode(size, pygame.RESIZABLE, vsync=int(data.userdata["vsync"]))
+			if size != [int(x) for x in data.userdata["screensize"]]:
+				self.resize(size)
+
+		router.begin()
+		Surfaces.update()
+		if profiling:
+			profiler.stop()
+			profiler.start("update")
+		render = True
+		if self.fixed:
+			render = self.simulate()
+		else:
+			self.update()
+		if profiling:
+			profiler.stop()
+			profiler.start("draw")
+		if not render:
+			if profiling:
+				profiler.stop()
+				profiler.stop()
+			return
+		compositor.begin()
+		for surface in Surfaces.visible():
+			surface.draw()
+		if self.overlay.visible:
+			self.overlay.draw(
+				pygame.display.get_surface(), Surfaces["StartScreen"].snowfall.particles.count,
+				self.pacer.report()["jitter"]
+			)
+		if profiling:
+			profiler.stop()
+			profiler.start("present")
+		compositor.present()
+		if profiling:
+			profiler.stop()
+			profiler.stop()
 
 class StartScreen(SurfaceManager):
 	def __init__(self, surface):
 		super().__init__()
 		self.surface = surface
 		self.settings = data.settings["ui"]["StartScreen"]
+		self.menu = [None]*3
+		self.menuz = [None]*3
+		self.rectmenu = [None]*3
+		self.rectmenuz = [None]*3
+		self.textmenu = [None]*3
+		self.hover = [False]*3
+		# Snow fall animation
+		self.snowfall = Snowfall(self.surface, self)
+		profiler.attach(self.snowfall, "Snowfall", ("update", "blitItems"))
+		self.batch = RenderBatch(self.surface)
+		self.regions = [None]*3
+		self.layout()
+		router.subscribe(pygame.MOUSEBUTTONUP, self.event, self)
+		# Aduio
+		audio.music.load("bg")
+		audio.music.bg.play(-1)
+
+	def layout(self, changed=None):
 		# Background
-		self.bg = pygame.image.load(BytesIO(data.media["startbg"])).convert_alpha()
-		self.bg = pygame.transform.smoothscale_by(self.bg, self.surface.get_height()/self.bg.get_height())
+		self.bg = scaleCache.scaleBy(
+			"startbg", lambda: assets.image("startbg"), self.surface.get_height()/assets.size("startbg")[1], owner=self
+		)
 		self.rectbg = self.bg.get_rect(center=self.surface.get_rect().center)
+		self.background = pygame.Surface(self.surface.get_size()).convert()
+		self.background.blit(self.bg, self.rectbg)
 		# Create main menu
-		self.pole = pygame.image.load(BytesIO(data.media["signboardpole"])).convert_alpha()
-		self.pole = pygame.transform.smoothscale_by(
-			self.pole, data.rect["signboardpole"]["size"][1]/self.pole.get_height()
-		)
-		self.rectpole = self.pole.get_rect()
-		for k, v in data.rect["signboardpole"].items(): 
-			if not isinstance(v, dict) and k != "size": setattr(self.rectpole, k, v)
+		if changed is None or "signboardpole" in changed:
+			self.pole = scaleCache.scaleBy(
+				"signboardpole", lambda: assets.image("signboardpole"),
+				data.rect["signboardpole"]["size"][1]/assets.size("signboardpole")[1], owner=self
+			)
+			self.rectpole = data.layout.place(self.pole.get_rect(), "signboardpole")
 		# Create button play, setting, credit
-		self.menu = [pygame.image.load(BytesIO(s)).convert_alpha() for s in data.media["signboard"]]
-		self.menuz = []
-		self.rectmenu = []
-		self.rectmenuz = []
-		self.menufont = []
-		self.textmenu = []
 		for i, name in enumerate(["play", "setting", "credit"]):
+			if changed is not None and not changed & {"button"+name, f"button{name}/text"}: continue
 			# Create Surface
-			height = data.rect["button"+name]["size"][1]/self.menu[i].get_height()
-			self.menuz.append(pygame.transform.smoothscale_by(self.menu[i], height*1.05))
-			self.menu[i] = pygame.transform.smoothscale_by(self.menu[i], height)
+			menu = lambda i=i: assets.image(f"signboard/{i}")
+			height = data.rect["button"+name]["size"][1]/assets.size(f"signboard/{i}")[1]
+			self.menuz[i] = scaleCache.scaleBy(f"signboard/{i}", menu, height*1.05, owner=self)
+			self.menu[i] = scaleCache.scaleBy(f"signboard/{i}", menu, height, owner=self)
 			# Create rect
-			self.rectmenu.append(self.menu[i].get_rect())
-			for k, v in data.rect["button"+name].items():
-				if not isinstance(v, dict) and k != "size": setattr(self.rectmenu[i], k, v)
-			self.rectmenuz.append(self.menuz[i].get_rect(center=self.rectmenu[i].center))
-			# Create font
-			size = data.rect["button"+name]["text"]["size"][1]*self.settings["menu"]["textfactor"]
-			self.menufont.append(pygame.freetype.Font(self.settings["menu"]["font"], size))
+			self.rectmenu[i] = data.layout.place(self.menu[i].get_rect(), "button"+name)
+			self.rectmenuz[i] = self.menuz[i].get_rect(center=self.rectmenu[i].center)
+			self.regions[i] = router.region(self, name, self.rectmenu[i])
 			# Render text
-			self.textmenu.append(self.menufont[i].render(
+			size = fonts.metrics.size(self.settings["menu"]["font"], data.rect["button"+name]["text"]["size"][1])
+			self.textmenu[i] = fonts.render(
+				self.settings["menu"]["font"], size,
 				data.language[name.upper()+"_BUTTON"], self.settings["menu"]["textcolor"]
-			))
+			)
 			self.textmenu[i][1].center = self.rectmenu[i].center
-		# Snow fall animation
-		self.snowfall = Snowfall(self.surface)
-		# Aduio
-		audio.music.load("bg")
-		audio.music.bg.play(-1)
+		# Unchanged sprites are added again so the atlas keeps them on relayout
+		atlas.add("signboardpole", self.pole, self)
+		for i in range(3):
+			atlas.add(f"signboard/{i}", self.menu[i], self)
+			atlas.add(f"signboard/{i}", self.menuz[i], self)
+
+	def resize(self, surface, changed):
+		self.surface = surface
+		self.batch.target = surface
+		self.snowfall.resize(surface)
+		self.layout(changed)
+
+	@staticmethod
+	def preload(surface):
+		jobs = [
+			("image", "startbg", [(surface.get_height(), 1)]),
+			("image", "signboardpole", [(data.rect["signboardpole"]["size"][1], 1)])
+		]
+		for i, name in enumerate(["play", "setting", "credit"]):
+			height = data.rect["button"+name]["size"][1]
+			jobs.append(("image", f"signboard/{i}", [(height, 1), (height, 1.05)]))
+		return jobs + Snowfall.preload()
 
 	def event(self, event):
-		if not self._event or not self._status: return
-		posMouse = pygame.mouse.get_pos()
-		if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
-			if self.rectmenu[0].collidepoint(posMouse):
-				self.pause_update() if self._update else self.start_update() 
-			elif self.rectmenu[1].collidepoint(posMouse):
-				if "SettingScreen" not in Surfaces:
-					Surfaces.update(SettingScreen=SettingScreen(self.surface))
-				else:
-					Surfaces["SettingScreen"].start()
-				self.pause_event()
-			elif self.rectmenu[2].collidepoint(posMouse):
-				for key in Surfaces.copy():
-					if key != "StartScreen": Surfaces.pop(key)
+		if event.button != 1: return
+		if router.target is self.regions[0]:
+			self.pause_update() if self._update else self.start_update() 
+		elif router.target is self.regions[1]:
+			Surfaces.open("SettingScreen", "overlay")
+			self.pause_event()
+		elif router.target is self.regions[2]:
+			for key in Surfaces.scenes.copy():
+				if key != "StartScreen": Surfaces.unload(key)
+			compositor.invalidate()
+	def pause_update(self):
+		super().pause_update()
+		self.snowfall.particles.settle(frameClock.alpha)
 	def update(self):
 		self.snowfall.update()
 	def draw(self):
 		if not self._status: return
-		posMouse = pygame.mouse.get_pos()
 		pressMouse = pygame.mouse.get_pressed()
 
-		if self._update: self.update()
+		hover = [router.hover is r and not pressMouse[0] for r in self.regions]
+		# Settings is the likely next scene once its button is hovered
+		if router.hover is self.regions[1]: Surfaces.prefetch("SettingScreen")
+		prev = self.snowfall.rects
+		snow = self.snowfall.blitItems()
+		# Only redraw regions that changed since the last frame
+		clips = compositor.mark(
+			prev + self.snowfall.rects + [r for r, a, b in zip(self.rectmenuz, hover, self.hover) if a != b]
+		)
+		self.hover = hover
 		# Draw
-		self.surface.blit(self.bg, self.rectbg)
-		self.snowfall.draw()
+		if clips is None:
+			self.batch.add(self.background, (0,0))
+		else:
+			for r in clips: self.batch.add(self.background, r, r)
+		self.batch.extend(snow)
 		# Draw menu
-		self.surface.blit(self.pole, self.rectpole)
+		self.batch.sprite("signboardpole", self.pole, self.rectpole, clips)
 		for i in range(3):
-			if self.rectmenu[i].collidepoint(posMouse) and not pressMouse[0] and self._event:
-				self.surface.blit(self.menuz[i], self.rectmenuz[i])
+			if hover[i]:
+				self.batch.sprite(f"signboard/{i}", self.menuz[i], self.rectmenuz[i], clips)
 			else:
-				self.surface.blit(self.menu[i], self.rectmenu[i])
-			self.surface.blit(self.textmenu[i][0], self.textmenu[i][1])
+				self.batch.sprite(f"signboard/{i}", self.menu[i], self.rectmenu[i], clips)
+			self.batch.sprite(None, self.textmenu[i][0], self.textmenu[i][1], clips)
+		self.batch.flush()
 
 class SettingScreen(SurfaceManager):
 	def __init__(self, surface):
 		super().__init__()
 		self.surface = surface
 		self.settings = data.settings["ui"]["SettingScreen"]
-		# Background
-		self.bg = pygame.Surface(self.surface.get_size(), pygame.SRCALPHA)
-		self.bg.fill(self.settings["bgcolor"])
+		self.musicSlider = None
+		self.layout()
+		router.subscribe(pygame.MOUSEBUTTONDOWN, self.event, self)
+		router.subscribe(pygame.MOUSEBUTTONUP, self.event, self)
+
+	def layout(self, changed=None):
 		# Board settings
-		self.setboard = pygame.Surface(data.rect["settingboard"]["size"], pygame.SRCALPHA)
-		self.rect = self.setboard.get_rect()
-		for k, v in data.rect["settingboard"].items():
-			if not isinstance(v, dict) and k != "size": setattr(self.rect, k, v)
+		self.rect = data.layout.place(pygame.Rect((0,0), data.rect["settingboard"]["size"]), "settingboard")
+		self.rect = self.rect.clip(self.surface.get_rect())
+		self.board = self.surface.subsurface(self.rect)
 		# Title
-		self.titlefont = pygame.freetype.Font(
+		self.title = fonts.render(
 			self.settings["titlefont"],
-			data.rect["settingboard"]["title"]["size"][1]*self.settings["titlefactor"]
+			fonts.metrics.size(self.settings["titlefont"], data.rect["settingboard"]["title"]["size"][1]),
+			data.language["TITLE_SETTING_BOARD"], self.settings["titlecolor"]
 		)
-		self.title = self.titlefont.render(data.language["TITLE_SETTING_BOARD"], self.settings["titlecolor"])
-		for k, v in data.rect["settingboard"]["title"].items():
-			if not isinstance(v, dict) and k != "size": setattr(self.title[1], k, v)
+		data.layout.place(self.title[1], "settingboard/title")
 		# Cancel button
-		cancel = pygame.image.load(BytesIO(data.media["cancelbutton"])).convert_alpha()
-		height = data.rect["settingboard"]["cancelbutton"]["size"][1]/cancel.get_height()
+		cancel = lambda: assets.image("cancelbutton")
+		height = data.rect["settingboard"]["cancelbutton"]["size"][1]/assets.size("cancelbutton")[1]
 		self.cancel = [
-			pygame.transform.smoothscale_by(cancel, height),
-			pygame.transform.smoothscale_by(cancel, height*1.19)
+			scaleCache.scaleBy("cancelbutton", cancel, height, owner=self),
+			scaleCache.scaleBy("cancelbutton", cancel, height*1.19, owner=self)
 		]
+		for cancel in self.cancel: atlas.add("cancelbutton", cancel, self)
 		self.rectcancel = [cancel.get_rect() for cancel in self.cancel]
 		self.rectcancel[0].topright = (self.rect.w-self.rectcancel[0].w, self.rectcancel[0].h)
 		self.rectcancel[1].center = self.rectcancel[0].center
+		self.cancelRegion = router.region(self, "cancel", self.rectcancel[0].move(self.rect.topleft), 1)
 		# Create audio settings
 		rect = pygame.Rect((0,0), data.rect["settingboard"]["musicslider"]["size"])
-		for k, v in data.rect["settingboard"]["musicslider"].items():
-			if not isinstance(v, dict) and k != "size": setattr(rect, k, v)
-		self.musicSlider = Slider(rect, self.settings["slidercolor"], (0,1))
-		self.musicSlider.pos_mouse((-self.rect.x, -self.rect.y))
+		data.layout.place(rect, "settingboard/musicslider")
+		if self.musicSlider is None or self.musicSlider.rect.size != rect.size:
+			self.musicSlider = Slider(rect, self.settings["slidercolor"], (0,1), self)
+		else:
+			self.musicSlider.move(rect)
+			self.musicSlider.pack()
 		self.musicSlider.level = data.userdata["music"]
+		self.musicSlider.pos_mouse((-self.rect.x, -self.rect.y))
+		self.batch = RenderBatch(self.board)
+		# Static layers are rendered once and composited into one surface
+		self.layers = LayerStack(self.surface.get_size())
+		self.layers.add("bg", Layer(self.surface.get_size(), lambda s: s.fill(self.settings["bgcolor"])))
+		self.layers.add("board", Layer(self.rect.size, self.renderBoard), self.rect)
+
+	def resize(self, surface, changed):
+		self.surface = surface
+		self.layout(changed)
+
+	@staticmethod
+	def preload(surface):
+		height = data.rect["settingboard"]["cancelbutton"]["size"][1]
+		return [("image", "cancelbutton", [(height, 1), (height, 1.19)])]
+
+	def renderBoard(self, surface):
+		pygame.draw.rect(
+			surface, self.settings["setboardcolor"], ((0,0),self.rect.size),
+			border_radius = self.rectcancel[0].h
+		)
+		surface.blit(self.title[0], self.title[1])
 
 	def event(self, event):
-		if not self._event or not self._status: return
-		posMouse = [x-y for x,y in zip(pygame.mouse.get_pos(), self.rect)]
 		self.musicSlider.event(event)
 		if event.type == pygame.MOUSEBUTTONUP and event.button == 1:
-			if self.rectcancel[0].collidepoint(posMouse):
+			if router.target is self.cancelRegion:
 				Surfaces["StartScreen"].start_event()
-				self.pause()
+				Surfaces.suspend("SettingScreen")
 
 	def update(self):
+		self.musicSlider.update()
 		if self.musicSlider.level != data.userdata["music"]:
 			data.userdata["music"] = self.musicSlider.level
 			data.updateUserdata()
@@ -385,29 +2040,23 @@ class SettingScreen(SurfaceManager):
 
 	def draw(self):
 		if not self._status: return
-		posMouse = [x-y for x,y in zip(pygame.mouse.get_pos(), self.rect)]
 		pressMouse = pygame.mouse.get_pressed()
-		if self._update: self.update()
-		# Draw backgorund
-		self.surface.blit(self.bg, (0,0))
-		# Draw setting board
-		pygame.draw.rect(
-			self.setboard, self.settings["setboardcolor"], ((0,0),self.rect.size),
-			border_radius = self.rectcancel[0].h
-		)
+		# The dim overlay covers the whole screen
+		compositor.invalidate()
+		# Draw background, board and title
+		self.surface.blit(self.layers.get(), (0,0))
 		# Draw cancel button
-		if self.rectcancel[0].collidepoint(posMouse) and not pressMouse[0] and self._event:
-			self.setboard.blit(self.cancel[1], self.rectcancel[1])
+		if router.hover is self.cancelRegion and not pressMouse[0]:
+			self.batch.sprite("cancelbutton", self.cancel[1], self.rectcancel[1])
 		else:
-			self.setboard.blit(self.cancel[0], self.rectcancel[0])
-		# Draw title
-		self.setboard.blit(self.title[0], self.title[1])
+			self.batch.sprite("cancelbutton", self.cancel[0], self.rectcancel[0])
+		self.batch.flush()
 		# Draw Music
-		self.musicSlider.draw(self.setboard)
-		self.surface.blit(self.setboard, self.rect)
+		self.musicSlider.draw(self.board)
 
 class Slider:
-	def __init__(self, rect, color, range):
+	def __init__(self, rect, color, range, owner=None):
+		self.owner = owner
 		self.posMouse = (0,0)
 		self.range = range
 		self.active = False
@@ -427,6 +2076,15 @@ class Slider:
 			renderCircle(self.chandle, self.rect.h/2*1.1, 4)
 		]
 		self.rhandle = [x.get_rect(center=self.rfill.midright) for x in self.handle]
+		self.pack()
+
+	def pack(self):
+		atlas.add("sliderfill", self.leftfill, self.owner)
+		for handle in self.handle: atlas.add("sliderhandle", handle, self.owner)
+
+	def move(self, rect):
+		offset = (rect[0]-self.rect.x, rect[1]-self.rect.y)
+		for r in [self.rect, self.rtrack, self.rfill, *self.rhandle]: r.move_ip(offset)
 
 	def event(self, event):
 		posMouse = [x+y for x,y in zip(self.posMouse, pygame.mouse.get_pos())]
@@ -451,14 +2109,15 @@ class Slider:
 	def draw(self, surface):
 		posMouse = [x+y for x,y in zip(self.posMouse, pygame.mouse.get_pos())]
 		pressMouse = pygame.mouse.get_pressed()
-		self.update()
 		surface.blit(self.track, self.rtrack)
-		surface.blit(self.leftfill, self.rfill)
 		pygame.draw.rect(surface, self.cfill, self.rfill, border_radius=self.rfill.h)
+		batch = RenderBatch(surface)
+		batch.sprite("sliderfill", self.leftfill, self.rfill)
 		if self.rhandle[0].collidepoint(posMouse) and not pressMouse[0]:
-			surface.blit(self.handle[1], self.rhandle[1])
+			batch.sprite("sliderhandle", self.handle[1], self.rhandle[1])
 		else:
-			surface.blit(self.handle[0], self.rhandle[0])
+			batch.sprite("sliderhandle", self.handle[0], self.rhandle[0])
+		batch.flush()
 
 	@property
 	def level(self):
@@ -475,23 +2134,32 @@ class Slider:
 	def is_active(self):
 		return self.active
 
-def renderCircle(color, radius, factor=2):
-	s = pygame.Surface((radius*2*factor, radius*2*factor), pygame.SRCALPHA)
-	pygame.draw.circle(s, color, (radius*factor, radius*factor), radius*factor)
-	s = pygame.transform.smoothscale_by(s, 1/factor)
-	s = maskFill(s, color)
+@functools.lru_cache(maxsize=256)
+def renderShape(shape, size, radius, color):
+	# Signed distance from each pixel centre to the edge, 1px of coverage ramp
+	w, h = size
+	radius = min(radius, w/2, h/2)
+	x = np.abs(np.arange(w) + 0.5 - w/2)[:, None]
+	y = np.abs(np.arange(h) + 0.5 - h/2)[None, :]
+	if shape == "circle":
+		dist = np.sqrt(x*x + y*y) - radius
+	else:
+		qx, qy = x - (w/2 - radius), y - (h/2 - radius)
+		dist = np.hypot(np.maximum(qx, 0), np.maximum(qy, 0)) + np.minimum(np.maximum(qx, qy), 0) - radius
+	s = pygame.Surface(size, pygame.SRCALPHA)
+	s.fill((*color[:3], 255))
+	alpha = pygame.surfarray.pixels_alpha(s)
+	alpha[:] = np.clip(0.5 - dist, 0, 1)*(color[3] if len(color) > 3 else 255) + 0.5
+	del alpha
 	return s
 
+# Results are shared between callers and must not be drawn on
+def renderCircle(color, radius, factor=2):
+	size = max(int(radius*2), 1)
+	return renderShape("circle", (size, size), radius, tuple(color))
+
 def renderRect(color, size, radius=0, factor=2):
-	s = pygame.Surface(size, pygame.SRCALPHA)
-	pygame.draw.rect(s, color, (0, radius, size[0], size[1]-radius*2))
-	pygame.draw.rect(s, color, (radius, 0, size[0]-radius*2, size[1]))
-	circle = renderCircle(color, radius, factor)
-	s.blit(circle, (0,0))
-	s.blit(circle, (size[0]-radius*2, 0))
-	s.blit(circle, (size[0]-radius*2, size[1]-radius*2))
-	s.blit(circle, (0, size[1]-radius*2))
-	return s
+	return renderShape("rect", (int(size[0]), int(size[1])), radius, tuple(color))
 
 def blendColor(surface, color, rect=None, flags=pygame.BLEND_RGBA_MULT):
 	surface = surface.copy()
@@ -505,55 +2173,150 @@ def maskFill(surface, color, rect=None):
 	surface.fill(color, rect, pygame.BLEND_RGBA_MULT)
 	return surface
 
-class Snow:
-	def __init__(self, snow, pos, speed):
-		self.snow = snow
-		self.rect = self.snow.get_rect(center = pos)
-		self.speed = speed
-		self.timefall = Timer(10)
-		self.timewind = Timer(30)
-		self.speedwind = random.choice([-1,0,1,1])
+class ParticleEngine:
+	def __init__(self, bounds, capacity=256, fall=10, wind=30):
+		self.bounds = pygame.Rect(bounds)
+		# Speeds are pixels per fall/wind period, stored as pixels per ms
+		self.cooldown = (fall, wind)
+		self.size = 0
+		self.free = []
+		self.count = 0
+		self.alloc(capacity)
 
-	def update(self):
-		if self.timewind.update():
-			self.rect.x += self.speedwind
-		if self.timefall.update():
-			self.rect.y += self.speed
+	def alloc(self, capacity):
+		old = self.size
+		fields = {
+			"x": np.float64, "y": np.float64, "px": np.float64, "py": np.float64,
+			"vx": np.float64, "vy": np.float64, "sprite": np.int32, "alive": np.bool_
+		}
+		for name, dtype in fields.items():
+			array = np.zeros(capacity, dtype)
+			if old: array[:old] = getattr(self, name)
+			setattr(self, name, array)
+		self.free.extend(range(capacity-1, old-1, -1))
+		self.size = capacity
 
-	def draw(self, surface):
-		surface.blit(self.snow, self.rect)
-	@property
-	def pos(self):
-		return self.rect.center
+	def spawn(self, pos, speed, wind, sprite):
+		if not self.free: self.alloc(self.size*2)
+		i = self.free.pop()
+		self.x[i], self.y[i] = self.px[i], self.py[i] = pos
+		self.vy[i] = speed/self.cooldown[0]
+		self.vx[i] = wind/self.cooldown[1]
+		self.sprite[i] = sprite
+		self.alive[i] = True
+		self.count += 1
+		return i
+
+	def update(self, dt):
+		if not self.count: return
+		alive = self.alive
+		# Keep the previous state for interpolated rendering
+		self.px[:] = self.x
+		self.py[:] = self.y
+		self.x += self.vx*dt
+		self.y += self.vy*dt
+		# Recycle particles that left the bounds
+		b = self.bounds
+		dead = alive & ((self.x < b.left) | (self.x >= b.right) | (self.y < b.top) | (self.y >= b.bottom))
+		if dead.any():
+			index = np.flatnonzero(dead)
+			self.alive[index] = False
+			self.free.extend(index.tolist())
+			self.count -= len(index)
+
+	def clear(self):
+		self.alive[:] = False
+		self.free = list(range(self.size-1, -1, -1))
+		self.count = 0
+
+	def live(self):
+		return np.flatnonzero(self.alive)
+
+	def settle(self, alpha):
+		# Hold particles where they were last drawn, a changing alpha would move them between two frozen ticks
+		self.x[:] = self.px + (self.x - self.px)*alpha
+		self.y[:] = self.py + (self.y - self.py)*alpha
+		self.px[:] = self.x
+		self.py[:] = self.y
+
+	def lerp(self, index, alpha):
+		if alpha >= 1: return self.x[index], self.y[index]
+		px, py = self.px[index], self.py[index]
+		return px + (self.x[index] - px)*alpha, py + (self.y[index] - py)*alpha
 
 class Snowfall:
-	def __init__(self, surface):
+	def __init__(self, surface, owner=None):
 		self.surface = surface
+		self.owner = self if owner is None else owner
 		self.rect = self.surface.get_rect()
-		self.snow = [pygame.image.load(BytesIO(snow)).convert_alpha() for snow in data.media["snow"]]
-		self.listSnow = []
-		self.timecreate = Timer(150)
+		self.snow = [f"snow/{i}" for i in range(len(data.media["snow"]))]
+		self.sprites = []
+		self.spriteIndex = {}
+		self.particles = ParticleEngine(self.rect)
+		self.half = np.zeros((0, 2), np.int32)
+		self.areas = []
+		for index in range(len(self.snow)):
+			for height in range(2, 20): self.sprite(index, height)
+		self.rects = []
+		self.timecreate = Timer(150, owner)
+
+	def sprite(self, index, height):
+		name = self.snow[index]
+		snow = scaleCache.scaleBy(name, lambda: assets.image(name), height/assets.size(name)[1], owner=self.owner)
+		key = (index, height)
+		if key not in self.spriteIndex:
+			self.spriteIndex[key] = len(self.sprites)
+			self.sprites.append(snow)
+			self.areas.append(atlas.add(f"snow/{index}", snow, self.owner))
+			self.half = np.append(self.half, [[snow.get_width()//2, snow.get_height()//2]], 0)
+		self.sprites[self.spriteIndex[key]] = snow
+		return self.spriteIndex[key]
+
+	def resize(self, surface):
+		self.surface = surface
+		self.rect = self.surface.get_rect()
+		self.particles.bounds = pygame.Rect(self.rect)
+		for (index, height), i in self.spriteIndex.items():
+			self.areas[i] = atlas.add(f"snow/{index}", self.sprites[i], self.owner)
+
+	@staticmethod
+	def preload():
+		return [("image", f"snow/{i}", [(h, 1) for h in range(2, 20)]) for i in range(len(data.media["snow"]))]
 
 	def createSnow(self):
 		speed = random.choice([1,1,1,2,2,3,3,6])
 		pos = (random.randint(0, self.surface.get_width()), 0)
 		height = random.randint(2, 19)
-		snow = random.choice(self.snow)
-		snow = pygame.transform.smoothscale_by(snow, height/snow.get_height())
-		self.listSnow.append(Snow(snow, pos, speed))
+		sprite = self.sprite(random.randrange(len(self.snow)), height)
+		self.particles.spawn(pos, speed, random.choice([-1,0,1,1]), sprite)
 		
 	def update(self):
 		if self.timecreate.update():
 			self.createSnow()
-		for snow in self.listSnow.copy():
-			if not self.rect.collidepoint(snow.pos):
-				self.listSnow.remove(snow)
-		for snow in self.listSnow:
-			snow.update()
+		self.particles.update(frameClock.dt)
 
-	def draw(self):
-		for snow in self.listSnow:
-			snow.draw(self.surface)
+	def blitItems(self):
+		p = self.particles
+		index = p.live()
+		sprite = p.sprite[index]
+		x, y = p.lerp(index, frameClock.alpha)
+		xs = (x.astype(np.int32) - self.half[sprite, 0]).tolist()
+		ys = (y.astype(np.int32) - self.half[sprite, 1]).tolist()
+		sprite = sprite.tolist()
+		source = atlas.surface
+		if compositor.enabled:
+			self.rects = [(x, y, *self.sprites[i].get_size()) for i, x, y in zip(sprite, xs, ys)]
+		return [
+			(source, (x, y), self.areas[i]) if self.areas[i] else (self.sprites[i], (x, y))
+			for i, x, y in zip(sprite, xs, ys)
+		]
+
+	def draw(self, batch=None):
+		items = self.blitItems()
+		if batch is None:
+			self.surface.blits(items, doreturn=False)
+		else:
+			batch.extend(items)
 
 if __name__ == "__main__":
 	game = Game()